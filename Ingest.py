@@ -0,0 +1,160 @@
+from MinHash import mix64
+import numpy as np
+import sys
+import zlib
+__author__ = 'Matt Barnes'
+
+
+_GZIP_MAGIC = '\x1f\x8b'
+_ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+_WHITESPACE = np.zeros(256, dtype=bool)
+_WHITESPACE[[ord(c) for c in ' \t\n\r\x0b\x0c']] = True
+
+
+def iter_documents(path, block_size=1 << 22):
+    """
+    Stream documents from a text file, one document per line, reading in large blocks.
+    Gzip and zstd input is detected from its magic bytes and decompressed on the fly.
+    :param path: Path to text file, or '-' for stdin
+    :param block_size: Bytes per read
+    :return: Generator of (zero-indexed line number, line string without its line break)
+    """
+    line_number = 0
+    remainder = ''
+    for block in iter_blocks(path, block_size=block_size):
+        lines = (remainder + block).split('\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line_number, line.rstrip('\r')
+            line_number += 1
+    if remainder:
+        yield line_number, remainder.rstrip('\r')
+
+
+def iter_blocks(path, block_size=1 << 22):
+    """
+    Stream decompressed blocks of a file
+    :param path: Path to file, or '-' for stdin. Plain, gzip or zstd
+    :param block_size: Bytes per read
+    :return: Generator of strings
+    """
+    if path == '-':
+        ins = getattr(sys.stdin, 'buffer', sys.stdin)
+    else:
+        ins = open(path, 'rb')
+    try:
+        block = ins.read(block_size)
+        if block.startswith(_GZIP_MAGIC):
+            decompressor = _GzipDecompressor()
+        elif block.startswith(_ZSTD_MAGIC):
+            decompressor = _zstd_decompressor()
+        else:
+            decompressor = None
+        while block:
+            if decompressor is None:
+                yield block
+            else:
+                data = decompressor.decompress(block)
+                if data:
+                    yield data
+            block = ins.read(block_size)
+    finally:
+        if ins is not sys.stdin and ins is not getattr(sys.stdin, 'buffer', None):
+            ins.close()
+
+
+class _GzipDecompressor(object):
+    """
+    Streaming gzip decompression, including files of several concatenated gzip members
+    """
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        out = [self._decompressor.decompress(data)]
+        while self._decompressor.unused_data:
+            unused_data = self._decompressor.unused_data
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out.append(self._decompressor.decompress(unused_data))
+        return ''.join(out)
+
+
+def _zstd_decompressor():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('Reading zstd input requires the zstandard package')
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+class Shingler(object):
+    """
+    Hash a document straight to a numpy uint64 vector of word or character n-gram shingles.
+    Tokens are hashed with vectorized polynomial rolling hashes, so no per-token Python objects are created.
+    """
+    _prime = np.uint64(0x100000001b3)
+    _prime_inverse = np.uint64(0xce965057aff6957b)  # Inverse of _prime modulo 2 ** 64
+
+    def __init__(self, shingle='word', ngram=1):
+        """
+        :param shingle: 'word' for whitespace delimited tokens, or 'char' for bytes
+        :param ngram: Int >= 1, number of consecutive tokens per shingle
+        """
+        if shingle not in ('word', 'char'):
+            raise ValueError('shingle must be word or char')
+        if ngram < 1:
+            raise ValueError('ngram must be at least 1')
+        self.shingle = shingle
+        self.ngram = ngram
+        self._powers = np.ones(1, dtype=np.uint64)
+        self._inverse_powers = np.ones(1, dtype=np.uint64)
+
+    def __call__(self, document):
+        """
+        :param document: String
+        :return shingles: Numpy uint64 vector, one hash per shingle (may contain repeats)
+        """
+        values = np.frombuffer(document, dtype=np.uint8).astype(np.uint64) + np.uint64(1)
+        if self.shingle == 'word':
+            values = self._word_hashes(values)
+        # Token hashes are linear in the bytes, so scramble them before the (also linear) n-gram combination
+        return self._ngrams(mix64(values))
+
+    def _word_hashes(self, values):
+        """
+        :param values: Numpy uint64 vector of byte values plus one
+        :return hashes: Numpy uint64 vector, one hash per whitespace delimited token
+        """
+        is_word = np.concatenate(([False], ~_WHITESPACE[values - np.uint64(1)], [False]))
+        edges = np.diff(is_word.astype(np.int8))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        self._grow_powers(len(values) + 1)
+        # prefix[i] = sum_{k < i} values[k] * prime ** k, so a token's hash is independent of its position
+        prefix = np.zeros(len(values) + 1, dtype=np.uint64)
+        np.cumsum(values * self._powers[:len(values)], out=prefix[1:])
+        return (prefix[ends] - prefix[starts]) * self._inverse_powers[starts]
+
+    def _ngrams(self, values):
+        """
+        :param values: Numpy uint64 vector of token hashes
+        :return hashes: Numpy uint64 vector, one hash per n-gram. Documents shorter than n give a single shingle
+        """
+        ngram = min(self.ngram, len(values))
+        if ngram == 0:
+            return np.empty(0, dtype=np.uint64)
+        number_shingles = len(values) - ngram + 1
+        hashes = values[:number_shingles].copy()
+        for offset in xrange(1, ngram):
+            hashes *= self._prime
+            hashes += values[offset:offset + number_shingles]
+        return hashes
+
+    def _grow_powers(self, length):
+        if len(self._powers) >= length:
+            return
+        length = max(length, 2 * len(self._powers))
+        self._powers = np.cumprod(np.concatenate((np.ones(1, dtype=np.uint64),
+                                                  np.full(length - 1, self._prime, dtype=np.uint64))))
+        self._inverse_powers = np.cumprod(np.concatenate((np.ones(1, dtype=np.uint64),
+                                                          np.full(length - 1, self._prime_inverse, dtype=np.uint64))))
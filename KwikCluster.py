@@ -1,8 +1,16 @@
 import argparse
+from Ingest import iter_documents, Shingler
 from itertools import izip
-from MinHash import MinHash, Banding, JaccardMatchFunction
+from MemoryPlanner import plan_memory, parse_bytes, sample_input, RSSTracker
+from MinHash import MinHash, Banding, JaccardMatchFunction, DenseSignatures
+import multiprocessing
+from NearDuplicateIndex import save_index, NearDuplicateIndex
+import numpy as np
 from numpy import Inf, random
+import os
+import shutil
 import sys
+import tempfile
 
 
 __author__ = 'Matt Barnes'
@@ -18,7 +26,8 @@ def main(argv):
 
     parser.add_argument("input_file_path",
                         type=str,
-                        help="Path to text file to cluster. One document per line.")
+                        help="Path to text file to cluster. One document per line. May be gzip or zstd "
+                             "compressed, or - for stdin.")
 
     parser.add_argument("output_file_path",
                         type=str,
@@ -45,28 +54,114 @@ def main(argv):
                         default=Inf,
                         help="Maximum number of lines to read from input-file-path.")
 
+    parser.add_argument("--shingle",
+                        type=str,
+                        choices=['word', 'char'],
+                        default='word',
+                        help="Tokenize documents into whitespace delimited words or characters.")
+
+    parser.add_argument("--ngram",
+                        type=int,
+                        default=1,
+                        help="Number of consecutive tokens per shingle.")
+
+    parser.add_argument("--index-path",
+                        type=str,
+                        default=None,
+                        help="Directory to save the MinHash and banding index to, for NearDuplicateIndex.py queries.")
+
+    parser.add_argument("--number-runs",
+                        type=int,
+                        default=1,
+                        help="Number of independent KwikCluster runs, combined with consensus clustering. Runs are "
+                             "spread over --number-processes processes sharing one index.")
+
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0,
+                        help="Random seed for pivot orders when --number-runs is more than 1.")
+
+    parser.add_argument("--memory-budget",
+                        type=str,
+                        default=None,
+                        help="Maximum memory to use, e.g. 8G. Signature and band representations are chosen to fit "
+                             "it before hashing starts.")
+
+    parser.add_argument("--number-documents",
+                        type=int,
+                        default=None,
+                        help="Number of documents, for --memory-budget. Estimated from the input if not given.")
+
+    parser.add_argument("--spill-path",
+                        type=str,
+                        default=None,
+                        help="Directory for signatures and band indices spilled to memory mapped files. Defaults to "
+                             "the system temporary directory.")
+
     args = parser.parse_args(argv)
 
     kwik_cluster_text_file(args)
 
 
 def kwik_cluster_text_file(args):
-    minhash = MinHash(args.number_hash_functions)
-    bands = Banding(args.number_hash_functions, args.threshold, number_processes=args.number_processes)
-    doc_ids_to_cluster = set()
-    with open(args.input_file_path, 'rb') as ins:
-        for line_number, line in enumerate(ins):
+    shingler = Shingler(args.shingle, args.ngram)
+    plan = None
+    tracker = None
+    if args.memory_budget is not None:
+        plan = _plan_text_file(args, shingler)
+        print 'Memory plan: ' + str(plan)
+        tracker = RSSTracker(plan)
+    spill_path = tempfile.mkdtemp(dir=args.spill_path)
+    try:
+        minhash = MinHash(args.number_hash_functions, signatures=_signature_store(plan, args.number_hash_functions,
+                                                                                  spill_path))
+        bands = Banding(args.number_hash_functions, args.threshold, number_processes=args.number_processes)
+        doc_ids_to_cluster = set()
+        for line_number, line in iter_documents(args.input_file_path):
             if line_number % 1000 == 0:
                 print 'Reading in document ' + str(line_number)
             if line_number > args.max_lines:
                 break
             doc_ids_to_cluster.add(line_number)
-            tokens = line.split(' ')
-            minhash.add_document(line_number, tokens)
-    minhash.finish()
-    bands.add_signatures(minhash.signatures)
-    match_function = JaccardMatchFunction(minhash, bands).match_function
-    clusters = kwik_cluster(match_function, doc_ids_to_cluster)
+            minhash.add_document(line_number, shingler(line))
+        minhash.finish()
+        if tracker is not None:
+            tracker.checkpoint('hashing')
+        if args.number_runs == 1 and (plan is None or plan.bands == 'dict'):
+            bands.add_signatures(minhash.signatures)
+            if args.index_path is not None:
+                save_index(args.index_path, minhash, bands, shingler=shingler)
+            bands.close()
+            if tracker is not None:
+                tracker.checkpoint('banding')
+            match_function = JaccardMatchFunction(minhash, bands).match_function
+            clusters = kwik_cluster(match_function, doc_ids_to_cluster)
+        else:
+            index_path = args.index_path if args.index_path is not None else os.path.join(spill_path, 'index')
+            save_index(index_path, minhash, bands, shingler=shingler)
+            bands.close()
+            del minhash, bands, doc_ids_to_cluster  # The index holds everything clustering needs
+            if tracker is not None:
+                tracker.checkpoint('banding')
+            if args.number_runs > 1:
+                labels = multi_kwik_cluster(index_path, args.number_runs, number_processes=args.number_processes,
+                                            seed=args.seed)
+                print 'Combining ' + str(args.number_runs) + ' KwikCluster runs with consensus clustering'
+                # Run r used seed + r, so the consensus pivot order must not reuse any of them
+                labels = consensus_clustering_labels(labels, seed=args.seed + args.number_runs)
+                index = NearDuplicateIndex(index_path)
+            else:
+                index = NearDuplicateIndex(index_path, mmap_mode='r' if plan.bands == 'memmap' else None)
+                labels = kwik_cluster_labels(index.match_rows, len(index),
+                                             np.random.RandomState(args.seed).permutation(len(index)))
+            clusters = label_array_to_clusters(labels, doc_ids=index.doc_ids)
+            del index
+        if tracker is not None:
+            tracker.checkpoint('clustering')
+    finally:
+        if tracker is not None:
+            tracker.close()
+        shutil.rmtree(spill_path)
     print 'Finished clustering. Found ', str(len(clusters)), ' clusters'
     with open(args.output_file_path, 'w') as ins:
         for cluster in clusters:
@@ -74,6 +169,46 @@ def kwik_cluster_text_file(args):
             ins.write(line + '\n')
 
 
+def _plan_text_file(args, shingler):
+    """
+    Choose signature and band representations that fit args.memory_budget, before any hashing
+    :param args: Parsed arguments, see main
+    :param shingler: Ingest.Shingler object
+    :return plan: MemoryPlanner.MemoryPlan object
+    """
+    number_documents = args.number_documents
+    shingles_per_doc = 100
+    if args.input_file_path != '-':
+        sampled_number_documents, shingles_per_doc = sample_input(args.input_file_path, shingler)
+        if number_documents is None:
+            number_documents = sampled_number_documents
+    elif number_documents is None:
+        raise ValueError('--number-documents is required with --memory-budget when reading stdin')
+    number_documents = int(min(number_documents, args.max_lines + 1))
+    number_bands_per_doc = args.number_hash_functions / Banding._calculate_bandwidth(args.number_hash_functions,
+                                                                                      args.threshold)
+    return plan_memory(number_documents, args.number_hash_functions, number_bands_per_doc,
+                       memory_budget=parse_bytes(args.memory_budget), shingles_per_doc=shingles_per_doc,
+                       number_runs=args.number_runs, number_processes=args.number_processes)
+
+
+def _signature_store(plan, number_hash_functions, spill_path):
+    """
+    :param plan: MemoryPlanner.MemoryPlan object. If None, a dict
+    :param number_hash_functions: Int >= 1
+    :param spill_path: Directory for memory mapped signatures
+    :return signatures: Empty mapping of [doc id, signature] for MinHash
+    """
+    if plan is None or plan.signatures == 'dict':
+        return dict()
+    dtype = np.uint32 if plan.signatures == 'compressed' else np.uint64
+    path = os.path.join(spill_path, 'signatures.dat') if plan.signatures == 'memmap' else None
+    # Growing briefly holds two copies, so leave headroom for a low sampled document count. Rows never written to are
+    # never resident
+    return DenseSignatures(number_hash_functions, number_docs=plan.number_documents + plan.number_documents / 4 + 1,
+                           dtype=dtype, path=path)
+
+
 def kwik_cluster(match_function, doc_indices, seed_queue=None):
     """
     KwikCluster (Ailon et al. 2008), with edges between any docs with at least one "feature"
@@ -153,6 +288,160 @@ def consensus_clustering(clusterings, seed_queue=None):
     return clusters
 
 
+def kwik_cluster_labels(match_rows, number_docs, pivots):
+    """
+    KwikCluster (Ailon et al. 2008) over docs 0, ..., number_docs - 1, with clusters stored as a label array
+    :param match_rows: Function handle. match_rows(pivot) returns numpy vector of all docs with edge to pivot
+    :param number_docs: Number of docs
+    :param pivots: Numpy vector, order to try pivots in. Usually a random permutation of range(number_docs)
+    :return labels: Numpy int vector, labels[doc] is the cluster label of doc
+    """
+    labels = np.empty(number_docs, dtype=np.int64)
+    labels.fill(-1)
+    number_clusters = 0
+    for pivot in pivots:
+        if labels[pivot] != -1:
+            continue
+        cluster = match_rows(pivot)
+        cluster = cluster[labels[cluster] == -1]
+        labels[cluster] = number_clusters
+        labels[pivot] = number_clusters
+        number_clusters += 1
+    return labels
+
+
+class _MemoizedMatchRows(object):
+    """
+    Memoizes each pivot's verified matches across the runs in a process, and reuses them for the symmetric pairs
+    """
+    def __init__(self, index):
+        """
+        :param index: NearDuplicateIndex object
+        """
+        self._index = index
+        self._matches = dict()
+        self.number_verified = 0
+        self.number_reused = 0
+
+    def match_rows(self, pivot):
+        if pivot in self._matches:
+            self.number_reused += len(self._matches[pivot])
+            return self._matches[pivot]
+        rows = self._index.candidate_rows(self._index.signatures[pivot])
+        is_match = np.zeros(len(rows), dtype=bool)
+        is_known = np.zeros(len(rows), dtype=bool)
+        for i, row in enumerate(rows):
+            matches = self._matches.get(row)
+            if matches is not None:  # Sorted, as candidate_rows are
+                is_known[i] = True
+                position = np.searchsorted(matches, pivot)
+                is_match[i] = position < len(matches) and matches[position] == pivot
+        is_match[~is_known] = self._index.verify_rows(pivot, rows[~is_known])
+        self.number_verified += np.count_nonzero(~is_known)
+        self.number_reused += np.count_nonzero(is_known)
+        self._matches[pivot] = rows[is_match]
+        return self._matches[pivot]
+
+
+_worker_match_rows = None
+
+
+def _init_multi_kwik_cluster_worker(index_path):
+    global _worker_match_rows
+    _worker_match_rows = _MemoizedMatchRows(NearDuplicateIndex(index_path))
+
+
+def _multi_kwik_cluster_worker(seeds):
+    """
+    :param seeds: List of ints, one run per seed
+    :return labels: List of numpy label vectors, one per seed
+    """
+    number_docs = len(_worker_match_rows._index)
+    return [kwik_cluster_labels(_worker_match_rows.match_rows, number_docs,
+                                np.random.RandomState(seed).permutation(number_docs)) for seed in seeds]
+
+
+def multi_kwik_cluster(index_path, number_runs, number_processes=1, seed=0):
+    """
+    Independent KwikCluster runs with different random pivot orders, over one shared read-only index.
+    Each worker process memory maps the index and runs a share of the runs, reusing its verified matches across them.
+    :param index_path: Directory written by save_index
+    :param number_runs: Number of KwikCluster runs
+    :param number_processes: Number of worker processes
+    :param seed: Run r uses random seed seed + r. Seed anything drawn afterwards with seed + number_runs or more
+    :return labels: Numpy int matrix, one row of index row labels per run
+    """
+    seeds = range(seed, seed + number_runs)
+    chunks = [seeds[i::number_processes] for i in range(number_processes) if seeds[i::number_processes]]
+    pool = multiprocessing.Pool(len(chunks), initializer=_init_multi_kwik_cluster_worker, initargs=(index_path,))
+    try:
+        chunk_labels = pool.map(_multi_kwik_cluster_worker, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    labels = np.empty((number_runs, len(chunk_labels[0][0])), dtype=np.int64)
+    for i, run_labels in enumerate(chunk_labels):
+        labels[i::number_processes] = run_labels
+    return labels
+
+
+class ConsensusLabelsMatchFunction(object):
+    """
+    ConsensusClusteringMatchFunction over a matrix of label arrays, one row per clustering
+    """
+    def __init__(self, labels, random_state=None):
+        """
+        :param labels: Numpy int matrix, labels[i, doc] is the cluster label of doc in clustering i
+        :param random_state: numpy RandomState. If None, uses the global numpy random state
+        """
+        self._labels = labels
+        self._random_state = random_state if random_state is not None else random
+        self._orders = [np.argsort(clustering_labels, kind='mergesort') for clustering_labels in labels]
+        self._sorted_labels = [clustering_labels[order] for clustering_labels, order in zip(labels, self._orders)]
+
+    def match_rows(self, doc):
+        """
+        Returns all matching docs, probabilistically
+        :param doc: Doc index
+        :return matches: Numpy vector of matching docs (including doc)
+        """
+        members = []
+        for clustering_labels, order, sorted_labels in zip(self._labels, self._orders, self._sorted_labels):
+            label = clustering_labels[doc]
+            start, end = np.searchsorted(sorted_labels, [label, label + 1])
+            members.append(order[start:end])
+        potential_matches, counts = np.unique(np.concatenate(members), return_counts=True)
+        probs = self._random_state.uniform(size=len(potential_matches))
+        matches = potential_matches[counts.astype(float) / len(self._labels) > probs]
+        return np.union1d(matches, [doc])
+
+
+def consensus_clustering_labels(labels, seed=None):
+    """
+    Consensus Clustering with KwikCluster (Ailon et al. 2008), over label arrays instead of sets
+    :param labels: Numpy int matrix, labels[i, doc] is the cluster label of doc in clustering i
+    :param seed: Random seed for pivot order and matches. If None, uses the global numpy random state
+    :return labels: Numpy int vector, consensus cluster label of each doc
+    """
+    random_state = np.random.RandomState(seed) if seed is not None else random
+    match_function = ConsensusLabelsMatchFunction(labels, random_state=random_state)
+    number_docs = labels.shape[1]
+    return kwik_cluster_labels(match_function.match_rows, number_docs, random_state.permutation(number_docs))
+
+
+def label_array_to_clusters(labels, doc_ids=None):
+    """
+    :param labels: Numpy int vector, labels[row] is the cluster label of row
+    :param doc_ids: Numpy vector mapping rows to doc ids. If None, rows are the doc ids
+    :return clusters: Frozen set of frozen sets, each subset contains doc ids in that cluster
+    """
+    if doc_ids is None:
+        doc_ids = np.arange(len(labels))
+    order = np.argsort(labels, kind='mergesort')
+    boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+    return frozenset([frozenset(doc_ids[rows].tolist()) for rows in np.split(order, boundaries) if len(rows)])
+
+
 def clusters_to_labels(clusters):
     """
     :param clusters: List of lists, each sublist contains doc ids in that cluster
@@ -165,6 +454,53 @@ def clusters_to_labels(clusters):
     return labels
 
 
+def clusters_to_label_array(clusters, number_docs):
+    """
+    :param clusters: List of lists, each sublist contains doc ids in that cluster. Doc ids are ints in [0, number_docs)
+    :param number_docs: Number of documents
+    :return labels: Numpy int vector, labels[doc_id] is the cluster label of doc_id. Docs in no cluster get
+                    singleton labels, so pairwise metrics do not treat them as one cluster
+    """
+    labels = np.empty(number_docs, dtype=np.int64)
+    labels.fill(-1)
+    number_clusters = 0
+    for label, cluster in enumerate(clusters):
+        labels[list(cluster)] = label
+        number_clusters += 1
+    unclustered = np.flatnonzero(labels == -1)
+    labels[unclustered] = number_clusters + np.arange(len(unclustered))
+    return labels
+
+
+def pairwise_precision_recall_f1(true_labels, predicted_labels):
+    """
+    Pairwise precision, recall and F1, counting pairs of docs in the same cluster via the cluster contingency table
+    :param true_labels: Numpy int vector of ground truth cluster labels, one per doc
+    :param predicted_labels: Numpy int vector of predicted cluster labels, aligned with true_labels
+    :return precision:
+    :return recall:
+    :return f1:
+    """
+    if len(true_labels) == 0:
+        return 1.0, 1.0, 1.0
+    _, true_labels = np.unique(true_labels, return_inverse=True)
+    _, predicted_labels = np.unique(predicted_labels, return_inverse=True)
+    _, joint_counts = np.unique(true_labels.astype(np.int64) * (predicted_labels.max() + 1) + predicted_labels,
+                                return_counts=True)
+    true_positives = _number_pairs(joint_counts)
+    predicted_pairs = _number_pairs(np.bincount(predicted_labels))
+    true_pairs = _number_pairs(np.bincount(true_labels))
+    precision = true_positives / predicted_pairs if predicted_pairs else 1.0
+    recall = true_positives / true_pairs if true_pairs else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return precision, recall, f1
+
+
+def _number_pairs(counts):
+    counts = counts.astype(np.float64)
+    return float(np.sum(counts * (counts - 1) / 2))
+
+
 def clean(doc_to_features, feature_to_docs, doc_id):
     """
     Removes ID from all traces of bands
@@ -0,0 +1,353 @@
+from hashlib import sha1
+from Ingest import iter_documents
+import math
+import numpy as np
+import os
+import resource
+import sys
+import threading
+__author__ = 'Matt Barnes'
+
+
+# Signature and band index representations, most preferred (fastest) first
+REPRESENTATIONS = [
+    ('dict', 'dict'),
+    ('compressed', 'dict'),
+    ('array', 'array'),
+    ('compressed', 'array'),
+    ('compressed', 'memmap'),
+    ('memmap', 'memmap'),
+]
+STAGES = ['hashing', 'banding', 'clustering']
+_SIGNATURE_ITEMSIZE = {'dict': 8, 'array': 8, 'compressed': 4, 'memmap': 8}
+_INT_BYTES = sys.getsizeof(10 ** 6)
+_ARRAY_BYTES = sys.getsizeof(np.empty(0, dtype=np.uint64))
+_DIGEST_BYTES = sys.getsizeof(sha1('').digest())
+_MAX_QUEUED_JOBS = 5000  # MinHash.add_document keeps at most this many unfinished jobs
+_READ_BLOCK_BYTES = 1 << 22  # Ingest.iter_documents reads blocks of this many bytes
+_BAND_KEY_BLOCK_SIZE = 1000  # save_index computes band keys for this many signatures at once
+_HASH_CHUNK_SIZE = 1 << 16  # MinHash._hash_integers computes at most this many hash values at once
+_NUMPY_INT_BYTES = sys.getsizeof(np.int64(0))
+_WORKER_BYTES = 2 << 20  # Pages of the parent a worker process copies on write, e.g. by touching reference counts
+_BANDING_CHUNK_SIZE = 1000  # Banding.add_signatures hands its workers at most this many signatures at once
+_OBJECT_OVERHEAD = 1.25  # Allocator overhead and fragmentation of many small Python objects, beyond sys.getsizeof
+
+
+def parse_bytes(text):
+    """
+    :param text: String such as '512M', '8G' or '1000000'
+    :return bytes: Int
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def format_bytes(number_bytes):
+    return '%.1f MB' % (float(number_bytes) / (1 << 20))
+
+
+class MemoryPlan(object):
+    """
+    Representations chosen for a run, with the predicted peak anonymous memory up to the end of each stage
+    """
+    def __init__(self, signatures, bands, stage_bytes, number_documents):
+        """
+        :param signatures: 'dict', 'array', 'compressed' (32 bit array) or 'memmap' (array spilled to a file)
+        :param bands: 'dict', 'array' or 'memmap' (sorted arrays memory mapped from the saved index)
+        :param stage_bytes: Dict of [stage, predicted bytes]
+        :param number_documents: Number of documents planned for
+        """
+        self.signatures = signatures
+        self.bands = bands
+        self.stage_bytes = stage_bytes
+        self.number_documents = number_documents
+
+    @property
+    def peak_bytes(self):
+        return max(self.stage_bytes.values())
+
+    def __str__(self):
+        stages = ', '.join([stage + ' ' + format_bytes(self.stage_bytes[stage]) for stage in STAGES])
+        return self.signatures + ' signatures, ' + self.bands + ' bands. Predicted ' + stages
+
+
+def estimate_memory(number_documents, number_hash_functions, number_bands_per_doc, signatures, bands,
+                    shingles_per_doc=100, baseline_bytes=0, number_runs=1, number_processes=1):
+    """
+    Predict peak anonymous memory up to the end of each stage, from the sizes of the Python and numpy objects involved.
+    Stages add to the memory still held by earlier ones. Pages of memory mapped files are not counted, since the kernel
+    can write them back and reclaim them. Band dictionaries and clusters are sized for the worst case of no two
+    documents sharing a band, and so are the matches each KwikCluster worker memoizes across runs.
+    :param number_documents: Number of documents
+    :param number_hash_functions: Int >= 1
+    :param number_bands_per_doc: Int >= 1
+    :param signatures: 'dict', 'array', 'compressed' or 'memmap'
+    :param bands: 'dict', 'array' or 'memmap'. Several runs cluster from a memory mapped index, so not 'dict'
+    :param shingles_per_doc: Average number of shingles per document, for the hashing queues and lines read
+    :param baseline_bytes: Memory in use before the run starts
+    :param number_runs: Number of KwikCluster runs combined with consensus clustering
+    :param number_processes: Number of banding and KwikCluster worker processes
+    :return stage_bytes: Dict of [stage, predicted bytes]
+    """
+    if number_runs > 1 and bands == 'dict':
+        raise ValueError('Several runs cluster from a saved index, so bands cannot be dict')
+    n = number_documents
+    number_band_entries = n * number_bands_per_doc
+    queues = min(n, _MAX_QUEUED_JOBS) * (2 * _ARRAY_BYTES + 8 * (shingles_per_doc + number_hash_functions))
+    doc_ids = _OBJECT_OVERHEAD * (_set_bytes(n) + n * _INT_BYTES)  # Set of doc ids to cluster
+    if signatures == 'dict':
+        signature_bytes = _OBJECT_OVERHEAD * (_dict_bytes(n) + n * (_INT_BYTES + _ARRAY_BYTES)) + \
+            n * 8 * number_hash_functions
+    elif signatures == 'memmap':
+        signature_bytes = n  # Only the presence mask is in memory
+    else:
+        signature_bytes = n * (number_hash_functions * _SIGNATURE_ITEMSIZE[signatures] + 1)
+    hashing_bytes = signature_bytes + queues + doc_ids
+    # While reading, a block is joined to the last line and the lines of two blocks are held, one string per line
+    lines_per_block = min(n, _READ_BLOCK_BYTES / max(shingles_per_doc, 1))
+    read_bytes = 4 * _READ_BLOCK_BYTES + 2 * lines_per_block * (sys.getsizeof('') + 8)
+    # The banding pool is started before hashing, and lives until banding is done. One MinHash worker hashes
+    pool_bytes = number_processes * _WORKER_BYTES
+    hashing_worker_bytes = _WORKER_BYTES + 3 * 8 * _HASH_CHUNK_SIZE
+    if bands == 'dict':
+        band_bytes = _OBJECT_OVERHEAD * (_dict_bytes(n) + n * (sys.getsizeof(set(range(number_bands_per_doc))) +
+                                                               number_bands_per_doc * _DIGEST_BYTES) +
+                                         _dict_bytes(number_band_entries) + number_band_entries * sys.getsizeof({0}))
+        # Computing band dictionaries, the garbage collector of each worker touches the objects it inherited, copying
+        # up to the baseline memory. Each also holds a chunk of signatures and their bands
+        chunk_bytes = max(1, min(n / number_processes, _BANDING_CHUNK_SIZE)) * (
+            _ARRAY_BYTES + 8 * number_hash_functions + sys.getsizeof(set(range(number_bands_per_doc))) +
+            number_bands_per_doc * _DIGEST_BYTES)
+        banding_bytes = hashing_bytes + band_bytes + number_processes * (baseline_bytes + chunk_bytes)
+        clusters = _OBJECT_OVERHEAD * (_set_bytes(n) + n * sys.getsizeof(frozenset([0])))
+        clustering_bytes = banding_bytes + clusters
+    else:
+        # save_index writes the index signatures to a memory mapped file while computing band keys a block at a time,
+        # then holds band keys, rows, their sort order (plus mergesort workspace) and one sorted copy at once
+        block_bytes = min(n, _BAND_KEY_BLOCK_SIZE) * (_ARRAY_BYTES + 16 * number_hash_functions +
+                                                      48 * number_bands_per_doc)
+        banding_bytes = hashing_bytes + 8 * n + max(16 * number_band_entries + block_bytes,
+                                                    36 * number_band_entries) + pool_bytes
+        # Signatures are freed before clustering loads the index, but little of the heap save_index used is reused
+        heap_bytes = 8 * n + 36 * number_band_entries + block_bytes
+        if bands == 'memmap' or number_runs > 1:
+            index_bytes = 0
+        else:
+            index_signature_bytes = n * number_hash_functions * _SIGNATURE_ITEMSIZE[signatures]
+            index_bytes = index_signature_bytes + 16 * number_band_entries + 8 * n
+        labels = 3 * 8 * n  # Labels, pivot permutation and doc ids
+        # label_array_to_clusters sorts the labels, splits them into one array per cluster and builds frozensets
+        clusters = 16 * n + n * (_ARRAY_BYTES + 8) + \
+            _OBJECT_OVERHEAD * (_set_bytes(n) + n * (_INT_BYTES + sys.getsizeof(frozenset([0])) + 8))
+        runs_bytes = 0
+        if number_runs > 1:
+            # Each worker memoizes the matches of every pivot it sees, and returns the labels of its runs pickled.
+            # The parent receives them all and copies them into one matrix, then consensus clustering sorts each run
+            number_workers = min(number_processes, number_runs)
+            runs_per_worker = -(-number_runs // number_workers)
+            memo_bytes = _OBJECT_OVERHEAD * (_dict_bytes(n) + n * (_NUMPY_INT_BYTES + _ARRAY_BYTES + 8))
+            worker_bytes = _WORKER_BYTES + memo_bytes + (2 * runs_per_worker + 2) * 8 * n
+            runs_bytes = max(number_workers * worker_bytes + (2 * number_runs + runs_per_worker) * 8 * n,
+                             3 * number_runs * 8 * n + 3 * 8 * n)
+        clustering_bytes = hashing_bytes - signature_bytes + heap_bytes + index_bytes + max(runs_bytes,
+                                                                                             labels + clusters)
+    peak_hashing_bytes = hashing_bytes + read_bytes + hashing_worker_bytes + pool_bytes
+    peak_banding_bytes = max(peak_hashing_bytes, banding_bytes)
+    return {
+        'hashing': baseline_bytes + int(peak_hashing_bytes),
+        'banding': baseline_bytes + int(peak_banding_bytes),
+        'clustering': baseline_bytes + int(max(peak_banding_bytes, clustering_bytes)),
+    }
+
+
+def plan_memory(number_documents, number_hash_functions, number_bands_per_doc, memory_budget=None,
+                shingles_per_doc=100, baseline_bytes=None, number_runs=1, number_processes=1):
+    """
+    Choose the most preferred representations whose predicted peak memory fits the budget
+    :param number_documents: Number of documents
+    :param number_hash_functions: Int >= 1
+    :param number_bands_per_doc: Int >= 1
+    :param memory_budget: Bytes. If None, the default dict representations are used
+    :param shingles_per_doc: Average number of shingles per document
+    :param baseline_bytes: Memory in use before the run starts. If None, the current anonymous memory
+    :param number_runs: Number of KwikCluster runs combined with consensus clustering
+    :param number_processes: Number of banding and KwikCluster worker processes
+    :return plan: MemoryPlan object
+    """
+    if baseline_bytes is None:
+        baseline_bytes = anonymous_bytes()
+    plans = []
+    for signatures, bands in REPRESENTATIONS:
+        if number_runs > 1 and bands == 'dict':
+            continue  # Several runs cluster from a saved index
+        stage_bytes = estimate_memory(number_documents, number_hash_functions, number_bands_per_doc, signatures,
+                                      bands, shingles_per_doc=shingles_per_doc, baseline_bytes=baseline_bytes,
+                                      number_runs=number_runs, number_processes=number_processes)
+        plan = MemoryPlan(signatures, bands, stage_bytes, number_documents)
+        if memory_budget is None or plan.peak_bytes <= memory_budget:
+            return plan
+        plans.append(plan)
+    smallest = min(plans, key=lambda p: p.peak_bytes)
+    raise MemoryError('No representation fits the memory budget of ' + format_bytes(memory_budget) +
+                      '. Smallest plan: ' + str(smallest))
+
+
+def sample_input(file_path, shingler, number_samples=1000):
+    """
+    Estimate the number of documents and shingles per document from a prefix of the input
+    :param file_path: Path to text file, one document per line. Plain files are sized from the sample,
+                      compressed files are counted in full
+    :param shingler: Ingest.Shingler object
+    :param number_samples: Number of lines to sample
+    :return number_documents: Estimated number of documents
+    :return shingles_per_doc: Average number of shingles per sampled document
+    """
+    if file_path == '-':
+        raise ValueError('Cannot sample stdin. Give the number of documents instead')
+    number_lines = 0
+    number_bytes = 0
+    number_shingles = 0
+    is_sampled_in_full = True
+    for line_number, line in iter_documents(file_path):
+        if line_number >= number_samples:
+            is_sampled_in_full = False
+            break
+        number_lines += 1
+        number_bytes += len(line) + 1
+        number_shingles += len(shingler(line))
+    if number_lines == 0:
+        return 0, 0.
+    shingles_per_doc = float(number_shingles) / number_lines
+    if is_sampled_in_full:
+        return number_lines, shingles_per_doc
+    with open(file_path, 'rb') as ins:
+        is_plain = not ins.read(4).startswith(('\x1f\x8b', '\x28\xb5\x2f\xfd'))
+    if is_plain:
+        number_documents = int(math.ceil(os.path.getsize(file_path) / (float(number_bytes) / number_lines)))
+    else:
+        number_documents = sum(1 for _ in iter_documents(file_path))
+    return number_documents, shingles_per_doc
+
+
+def anonymous_bytes(children=()):
+    """
+    Anonymous memory is what a run has to fit in. Pages of memory mapped files are left out, since the kernel can write
+    them back and reclaim them under memory pressure
+    :param children: Process ids of child processes to include, see child_pids. Pages a child still shares with this
+                     process since the fork are split between them (Pss_Anon), so they are counted once
+    :return bytes: Current anonymous resident memory. Peak resident set size of this process if /proc is unavailable
+    """
+    if not children:
+        number_bytes = _proc_bytes('self', 'status', 'RssAnon:')
+        if number_bytes is None:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return number_bytes
+    return sum([_proportional_anonymous_bytes(pid) for pid in ['self'] + list(children)])
+
+
+def child_pids():
+    """
+    :return pids: List of process ids of the child processes of this process, such as multiprocessing workers
+    """
+    pid = os.getpid()
+    children = []
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return children
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', name, 'stat'), 'r') as ins:
+                stat = ins.read()
+        except IOError:
+            continue
+        if int(stat[stat.rindex(')') + 2:].split()[1]) == pid:  # State and parent follow the parenthesized name
+            children.append(int(name))
+    return children
+
+
+def _proportional_anonymous_bytes(pid):
+    number_bytes = _proc_bytes(pid, 'smaps_rollup', 'Pss_Anon:')
+    if number_bytes is None:
+        number_bytes = _proc_bytes(pid, 'status', 'RssAnon:')  # Counts pages shared since a fork in each process
+    return number_bytes or 0
+
+
+def _proc_bytes(pid, name, field):
+    try:
+        with open(os.path.join('/proc', str(pid), name), 'r') as ins:
+            for line in ins:
+                if line.startswith(field):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+class RSSTracker(object):
+    """
+    Compares anonymous memory of this process and its children against a MemoryPlan at each stage boundary. The
+    kernel keeps no peak of anonymous memory, so a background thread samples it
+    """
+    def __init__(self, plan, interval=0.01, child_interval=0.5):
+        """
+        :param plan: MemoryPlan object
+        :param interval: Seconds between samples
+        :param child_interval: Seconds between looking up child processes, which scans /proc
+        """
+        self._plan = plan
+        self.stage_bytes = dict()
+        self._peak_bytes = anonymous_bytes()
+        self._is_closed = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, args=(interval, max(1, int(child_interval / interval))))
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def _sample(self, interval, number_samples_per_lookup):
+        children = []
+        number_samples = 0
+        while not self._is_closed.wait(interval):
+            if number_samples % number_samples_per_lookup == 0:
+                children = child_pids()
+            self._peak_bytes = max(self._peak_bytes, anonymous_bytes(children))
+            number_samples += 1
+
+    def close(self):
+        """
+        Stop sampling
+        """
+        self._is_closed.set()
+        self._sampler.join()
+
+    def checkpoint(self, stage):
+        """
+        Record and print anonymous memory at the end of a stage. Predictions are of the peak, which is what is compared
+        :param stage: One of STAGES
+        :return bytes: Peak anonymous memory so far
+        """
+        current = anonymous_bytes(child_pids())
+        self._peak_bytes = peak = max(self._peak_bytes, current)
+        self.stage_bytes[stage] = peak
+        predicted = self._plan.stage_bytes[stage]
+        print 'Memory after ' + stage + ': ' + format_bytes(current) + ' anonymous, ' + format_bytes(peak) + \
+              ' peak, ' + format_bytes(predicted) + ' predicted' + (' (over prediction)' if peak > predicted else '')
+        return peak
+
+
+def _dict_bytes(number_entries):
+    # CPython 2 dicts keep at most 2/3 of their slots full, 24 bytes per slot
+    return sys.getsizeof(dict()) + 24 * _table_size(number_entries * 3 / 2 + 1)
+
+
+def _set_bytes(number_entries):
+    # CPython 2 sets keep at most 3/5 of their slots full, 16 bytes per slot
+    return sys.getsizeof(set()) + 16 * _table_size(number_entries * 5 / 3 + 1)
+
+
+def _table_size(minimum_slots):
+    return 1 << int(math.ceil(math.log(max(minimum_slots, 8), 2)))
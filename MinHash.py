@@ -3,6 +3,7 @@ import random
 from hashlib import sha1
 from scipy.spatial.distance import hamming
 import multiprocessing
+import os
 from functools import partial
 import copy_reg
 import types
@@ -21,6 +22,7 @@ class JaccardMatchFunction(object):
         """
         self._minhash = minhash
         self._banding = banding
+        self.number_candidates = 0
 
     def match_function(self, pivot_doc_id):
         """
@@ -32,12 +34,27 @@ class JaccardMatchFunction(object):
         in_bands_doc_ids = set()
         for band in bands:
             in_bands_doc_ids.update(set(self._banding.band_to_docs[band]))
-        matches = set()
-        for doc_id in in_bands_doc_ids:
-            if self._minhash.jaccard(pivot_doc_id, doc_id) > self._banding.get_threshold():
-                matches.add(doc_id)
+        in_bands_doc_ids = list(in_bands_doc_ids)
+        self.number_candidates += len(in_bands_doc_ids)
+        candidate_signatures = np.array([self._minhash.signatures[doc_id] for doc_id in in_bands_doc_ids])
+        is_match, _ = self.verify(self._minhash.signatures[pivot_doc_id], candidate_signatures,
+                                  self._banding.get_threshold())
+        matches = set([doc_id for doc_id, match in zip(in_bands_doc_ids, is_match) if match])
         return matches
 
+    @staticmethod
+    def verify(signatures, candidate_signatures, threshold):
+        """
+        Vectorized MinHash Jaccard check of candidate signatures against pivot signatures
+        :param signatures: Numpy signature vector, or matrix with one row per candidate
+        :param candidate_signatures: Numpy matrix, one candidate signature per row
+        :param threshold: Jaccard threshold in [0, 1]
+        :return is_match: Boolean numpy vector, True where the approximate Jaccard coefficient is above threshold
+        :return scores: Numpy vector of approximate Jaccard coefficients
+        """
+        scores = np.mean(candidate_signatures == signatures, axis=1)
+        return scores > threshold, scores
+
 
 class Worker(multiprocessing.Process):
     """
@@ -72,10 +89,12 @@ class MinHash(object):
     """
     MinHash (Broder 1997)
     """
-    def __init__(self, number_hash_functions, number_processes=1):
+    def __init__(self, number_hash_functions, number_processes=1, signatures=None):
         """
         :param number_hash_functions: Int >= 1
-        :param number_processes: Number of processes to hash documents with
+        :param number_processes: Number of processes to hash documents with. Use 0 to only call hash_document
+        :param signatures: Empty mapping of [doc id, signature] to store signatures in, e.g. DenseSignatures.
+                           If None, a dict
         """
         self._number_hash_functions = number_hash_functions
         self._mersenne_prime = (1 << 89) - 1  # (x << n) is x shifted left by n bit
@@ -86,7 +105,13 @@ class MinHash(object):
         self._a, self._b = np.array(
             [(random.randint(1, self._mersenne_prime), random.randint(0, self._mersenne_prime)) for _ in
              xrange(number_hash_functions)]).T
-        self.signatures = dict()
+        # Multiply-shift hash functions for integer shingles. Like _a, _b, the first k hash functions do not
+        # depend on number_hash_functions, so truncated signatures equal those of a smaller MinHash.
+        integer_random = random.Random(428)
+        self._integer_a, self._integer_b = np.array(
+            [(integer_random.getrandbits(64) | 1, integer_random.getrandbits(64)) for _ in
+             xrange(number_hash_functions)], dtype=np.uint64).T.copy()
+        self.signatures = signatures if signatures is not None else dict()
         self._number_jobs = 0
         self._number_finished_jobs = 0
 
@@ -121,19 +146,41 @@ class MinHash(object):
         print 'Joining workers'
         for worker in self._worker_pool:
             worker.join()
+        self._worker_pool = list()  # Workers reference this object, so keeping them would leave it to the collector
 
     def hash_document(self, document):
         """
         MinHash signature of a single document, does not add to dataset
-        :param document: Set of tokens
+        :param document: Set of string tokens, or numpy integer vector of shingle hashes (see Ingest.Shingler).
+                         Signatures of the two kinds are not comparable with each other.
         :return signature: numpy vector of MinHash signature
         """
+        if isinstance(document, np.ndarray):
+            return self._hash_integers(document)
         signature = np.empty(self._number_hash_functions, dtype=np.uint64)
         signature.fill(self._max_hash)
         for token in document:
             signature = np.minimum(self._hash_token(token), signature)
         return signature
 
+    def _hash_integers(self, shingles, chunk_size=1 << 16):
+        """
+        Apply all hash functions to all shingles, vectorized
+        :param shingles: Numpy integer vector
+        :param chunk_size: Maximum number of hash values computed at once
+        :return signature: numpy vector of MinHash signature
+        """
+        signature = np.empty(self._number_hash_functions, dtype=np.uint64)
+        signature.fill(self._max_hash)
+        shingles = mix64(shingles.astype(np.uint64))
+        step = max(1, chunk_size // self._number_hash_functions)
+        for start in xrange(0, len(shingles), step):
+            values = np.multiply.outer(self._integer_a, shingles[start:start + step])
+            values += self._integer_b[:, np.newaxis]
+            values >>= np.uint64(1)  # Keep within _max_hash
+            signature = np.minimum(values.min(axis=1), signature)
+        return signature
+
     def _hash_token(self, token):
         """
         Apply all hash functions to a single token
@@ -158,19 +205,91 @@ class MinHash(object):
         return j
 
 
+class DenseSignatures(object):
+    """
+    Signature storage in one numpy matrix instead of a dict of vectors, for integer doc ids 0, 1, 2, ...
+    Supports the dict methods MinHash, Banding and JaccardMatchFunction use.
+    """
+    def __init__(self, number_hash_functions, number_docs=1024, dtype=np.uint64, path=None):
+        """
+        :param number_hash_functions: Int >= 1
+        :param number_docs: Initial capacity. Grows when exceeded
+        :param dtype: Numpy dtype. np.uint32 keeps only the low 32 bits of each hash value, halving memory
+        :param path: File to memory map the matrix to. If None, kept in memory
+        """
+        self._number_hash_functions = number_hash_functions
+        self._dtype = np.dtype(dtype)
+        self._path = path
+        self._array = self._allocate(max(1, number_docs))
+        self._present = np.zeros(len(self._array), dtype=bool)
+        self._number_signatures = 0
+
+    def _allocate(self, number_docs):
+        shape = (number_docs, self._number_hash_functions)
+        if self._path is None:
+            return np.empty(shape, dtype=self._dtype)
+        if os.path.exists(self._path):
+            os.remove(self._path)  # Old mapping stays valid until released
+        return np.memmap(self._path, dtype=self._dtype, mode='w+', shape=shape)
+
+    def _grow(self, number_docs):
+        old_array = self._array
+        self._array = self._allocate(max(number_docs, 2 * len(old_array)))
+        self._array[:len(old_array)] = old_array
+        present = np.zeros(len(self._array), dtype=bool)
+        present[:len(self._present)] = self._present
+        self._present = present
+
+    def __setitem__(self, doc_id, signature):
+        if doc_id >= len(self._array):
+            self._grow(doc_id + 1)
+        self._array[doc_id] = signature
+        if not self._present[doc_id]:
+            self._present[doc_id] = True
+            self._number_signatures += 1
+
+    def __getitem__(self, doc_id):
+        if not 0 <= doc_id < len(self._present) or not self._present[doc_id]:
+            raise KeyError(doc_id)
+        return self._array[doc_id]
+
+    def __contains__(self, doc_id):
+        return 0 <= doc_id < len(self._present) and self._present[doc_id]
+
+    def __len__(self):
+        return self._number_signatures
+
+    def keys(self):
+        return np.flatnonzero(self._present).tolist()
+
+    def doc_ids(self):
+        """
+        :return doc_ids: Sorted numpy int64 vector of doc ids, without the Python ints of keys()
+        """
+        return np.flatnonzero(self._present).astype(np.int64)
+
+    def iteritems(self):
+        for doc_id in np.flatnonzero(self._present):
+            yield int(doc_id), self._array[doc_id]
+
+
 class Banding(object):
     """
     Banding the MinHash signatures for quickly finding neighbors
     """
-    def __init__(self, number_hash_functions, threshold, number_processes=1):
+    def __init__(self, number_hash_functions, threshold, number_processes=1, bandwidth=None):
         """
         :param number_hash_functions: Integer, number of hash functions
         :param threshold: Jaccard threshold in [0, 1]
         :param number_processes: For multiprocessing
+        :param bandwidth: Integer, rows per band. If None, chosen from threshold
         """
         self.pool = multiprocessing.Pool(number_processes)
         self._threshold = threshold
-        bandwidth = self._calculate_bandwidth(number_hash_functions, self._threshold)
+        if bandwidth is None:
+            bandwidth = self._calculate_bandwidth(number_hash_functions, self._threshold)
+        elif not 1 <= bandwidth <= number_hash_functions:
+            raise ValueError('bandwidth must be between 1 and number_hash_functions')
         self._number_bands_per_doc = number_hash_functions / bandwidth
         self.band_to_docs = dict()
         self.doc_to_bands = dict()
@@ -197,6 +316,13 @@ class Banding(object):
         """
         return self._threshold
 
+    def get_number_bands_per_doc(self):
+        """
+        Returns the number of bands each signature is split into
+        :return number_bands_per_doc:
+        """
+        return self._number_bands_per_doc
+
     def add_signatures(self, signatures):
         """
         Add multiple signatures to the banding
@@ -284,6 +410,40 @@ def compute_bands(number_bands_per_doc, docid_signature):
     return docid, bands
 
 
+def mix64(values):
+    """
+    SplitMix64 finalizer, scrambles the bits of integer hashes
+    :param values: Numpy uint64 vector
+    :return mixed: Numpy uint64 vector
+    """
+    values = values ^ (values >> np.uint64(30))
+    values *= np.uint64(0xbf58476d1ce4e5b9)
+    values ^= values >> np.uint64(27)
+    values *= np.uint64(0x94d049bb133111eb)
+    values ^= values >> np.uint64(31)
+    return values
+
+
+def signature_band_keys(number_bands_per_doc, signatures):
+    """
+    Integer keys of the bands of signatures, split as by compute_bands, for sorted array band indices. Each key mixes
+    a band's values with its band number, so keys only depend on the values and not on how numpy prints them
+    :param number_bands_per_doc
+    :param signatures: Numpy matrix with one signature per row, or a single signature vector
+    :return keys: Numpy uint64 matrix, one row of band keys per signature
+    """
+    signatures = np.atleast_2d(signatures).astype(np.uint64)
+    bandwidth, remainder = divmod(signatures.shape[1], number_bands_per_doc)
+    bands = np.arange(number_bands_per_doc)
+    starts = bands * bandwidth + np.minimum(bands, remainder)
+    keys = np.tile(mix64(bands.astype(np.uint64) + np.uint64(1)), (len(signatures), 1))
+    for offset in xrange(bandwidth):
+        keys = mix64(keys ^ signatures[:, starts + offset])
+    if remainder:  # The first bands are one value wider
+        keys[:, :remainder] = mix64(keys[:, :remainder] ^ signatures[:, starts[:remainder] + bandwidth])
+    return keys
+
+
 def _pickle_method(method):
     func_name = method.im_func.__name__
     obj = method.im_self
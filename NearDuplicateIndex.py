@@ -0,0 +1,443 @@
+import argparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import json
+import multiprocessing
+import os
+import Queue
+from SocketServer import ThreadingMixIn
+import sys
+import threading
+import time
+from Ingest import Shingler
+from MinHash import MinHash, JaccardMatchFunction, DenseSignatures, signature_band_keys
+import numpy as np
+
+
+__author__ = 'Matt Barnes'
+
+
+BAND_KEYS = 'mix64'  # Stored with each index, so indices with other band keys are rejected instead of matching nothing
+
+
+def main(argv):
+    """
+    Serve near-duplicate queries over HTTP against a persisted index.
+    POST /query with JSON {"documents": [text, ...]}, GET /stats for latency percentiles.
+    :param argv: See below
+    :return:
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("index_path",
+                        type=str,
+                        help="Path to an index directory written by save_index (see KwikCluster.py --index-path).")
+
+    parser.add_argument("--host",
+                        type=str,
+                        default='127.0.0.1',
+                        help="Address to listen on.")
+
+    parser.add_argument("--port",
+                        type=int,
+                        default=8080,
+                        help="Port to listen on.")
+
+    parser.add_argument("--number-processes",
+                        type=int,
+                        default=1,
+                        help="Number of server processes sharing the memory mapped index.")
+
+    parser.add_argument("--max-batch-size",
+                        type=int,
+                        default=64,
+                        help="Maximum number of concurrent queries verified together.")
+
+    parser.add_argument("--max-batch-wait",
+                        type=float,
+                        default=0.001,
+                        help="Seconds to wait for more concurrent queries before verifying a batch.")
+
+    args = parser.parse_args(argv)
+
+    serve(args.index_path, args.host, args.port, number_processes=args.number_processes,
+          max_batch_size=args.max_batch_size, max_batch_wait=args.max_batch_wait)
+
+
+def save_index(path, minhash, banding, shingler=None, block_size=1000):
+    """
+    Persist MinHash signatures and bands as flat numpy arrays, which can be memory mapped read-only
+    :param path: Directory to write the index to. Created if it does not exist
+    :param minhash: MinHash object, after finish()
+    :param banding: Banding object the signatures were banded with
+    :param shingler: Ingest.Shingler the documents were hashed with. None if they were space delimited string tokens
+    :param block_size: Number of signatures band keys are computed for at once
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    if isinstance(minhash.signatures, DenseSignatures):
+        doc_ids = minhash.signatures.doc_ids()
+    else:
+        doc_ids = np.array(sorted(minhash.signatures.keys()), dtype=np.int64)
+    number_bands_per_doc = banding.get_number_bands_per_doc()
+    signature_dtype = minhash.signatures[doc_ids[0]].dtype if len(doc_ids) else np.dtype(np.uint64)
+    signatures = np.lib.format.open_memmap(os.path.join(path, 'signatures.npy'), mode='w+', dtype=signature_dtype,
+                                           shape=(len(doc_ids), minhash._number_hash_functions))
+    keys = np.empty((len(doc_ids), number_bands_per_doc), dtype=np.uint64)
+    rows = np.repeat(np.arange(len(doc_ids), dtype=np.int64), number_bands_per_doc)
+    for start in xrange(0, len(doc_ids), block_size):
+        block = np.array([minhash.signatures[doc_id] for doc_id in doc_ids[start:start + block_size]],
+                         dtype=signature_dtype)
+        signatures[start:start + len(block)] = block
+        keys[start:start + len(block)] = signature_band_keys(number_bands_per_doc, block)
+    keys = keys.ravel()
+    del signatures  # Flush to disk
+    order = np.argsort(keys, kind='mergesort')
+    np.save(os.path.join(path, 'doc_ids.npy'), doc_ids)
+    np.save(os.path.join(path, 'band_keys.npy'), keys[order])
+    del keys
+    np.save(os.path.join(path, 'band_rows.npy'), rows[order])
+    meta = {
+        'number_hash_functions': minhash._number_hash_functions,
+        'threshold': banding.get_threshold(),
+        'number_bands_per_doc': number_bands_per_doc,
+        'band_keys': BAND_KEYS,
+        'a': [int(a) for a in minhash._a],
+        'b': [int(b) for b in minhash._b],
+        'integer_a': [int(a) for a in minhash._integer_a],
+        'integer_b': [int(b) for b in minhash._integer_b],
+        'shingle': shingler.shingle if shingler is not None else None,
+        'ngram': shingler.ngram if shingler is not None else None,
+    }
+    with open(os.path.join(path, 'index.json'), 'w') as ins:
+        json.dump(meta, ins)
+    print 'Saved index of ' + str(len(doc_ids)) + ' documents to ' + path
+
+
+class NearDuplicateIndex(object):
+    """
+    Read-only MinHash + banding index, for querying near-duplicates of new documents.
+    Arrays are memory mapped, so processes loading the same index share its pages instead of copying them.
+    """
+    def __init__(self, path, mmap_mode='r'):
+        """
+        :param path: Directory written by save_index
+        :param mmap_mode: Numpy memory map mode. None loads the arrays into memory
+        """
+        with open(os.path.join(path, 'index.json'), 'r') as ins:
+            meta = json.load(ins)
+        if meta.get('band_keys') != BAND_KEYS:
+            raise ValueError('Index at ' + path + ' was saved with other band keys. Save it again with save_index')
+        self._threshold = meta['threshold']
+        self._number_bands_per_doc = meta['number_bands_per_doc']
+        self.doc_ids = np.load(os.path.join(path, 'doc_ids.npy'), mmap_mode=mmap_mode)
+        self.signatures = np.load(os.path.join(path, 'signatures.npy'), mmap_mode=mmap_mode)
+        self._band_keys = np.load(os.path.join(path, 'band_keys.npy'), mmap_mode=mmap_mode)
+        self._band_rows = np.load(os.path.join(path, 'band_rows.npy'), mmap_mode=mmap_mode)
+        self._minhash = MinHash(meta['number_hash_functions'], number_processes=0)
+        self._minhash._a = np.array([long(a) for a in meta['a']], dtype=object)
+        self._minhash._b = np.array([long(b) for b in meta['b']], dtype=object)
+        self._minhash._integer_a = np.array(meta['integer_a'], dtype=np.uint64)
+        self._minhash._integer_b = np.array(meta['integer_b'], dtype=np.uint64)
+        self._shingler = Shingler(meta['shingle'], meta['ngram']) if meta['shingle'] is not None else None
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def get_threshold(self):
+        """
+        Returns the threshold the index was built at
+        :return threshold:
+        """
+        return self._threshold
+
+    def hash_document(self, document):
+        """
+        MinHash signature of a document, with the same hash functions the index was built with
+        :param document: Set of tokens
+        :return signature: numpy vector of MinHash signature, with the dtype of the indexed signatures
+        """
+        return self._minhash.hash_document(document).astype(self.signatures.dtype)
+
+    def hash_text(self, text):
+        """
+        MinHash signature of a raw document, tokenized the same way as the index
+        :param text: String
+        :return signature: numpy vector of MinHash signature
+        """
+        if self._shingler is not None:
+            return self.hash_document(self._shingler(text))
+        return self.hash_document(text.split(' '))
+
+    def candidate_rows(self, signature):
+        """
+        :param signature: numpy vector of MinHash signature
+        :return rows: Numpy vector of unique index rows sharing at least one band with signature
+        """
+        keys = signature_band_keys(self._number_bands_per_doc, signature)[0]
+        starts = np.searchsorted(self._band_keys, keys, side='left')
+        ends = np.searchsorted(self._band_keys, keys, side='right')
+        rows = [self._band_rows[start:end] for start, end in zip(starts, ends) if end > start]
+        if not rows:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(rows))
+
+    def match_rows(self, row):
+        """
+        Indexed documents with Jaccard coefficient above threshold, like JaccardMatchFunction.match_function
+        :param row: Index row of the pivot document
+        :return rows: Numpy vector of matching index rows. Includes row.
+        """
+        rows = self.candidate_rows(self.signatures[row])
+        return rows[self.verify_rows(row, rows)]
+
+    def verify_rows(self, row, rows):
+        """
+        :param row: Index row of the pivot document
+        :param rows: Numpy vector of index rows to verify against it
+        :return is_match: Boolean numpy vector, True where the Jaccard estimate with row is above threshold
+        """
+        is_match, _ = JaccardMatchFunction.verify(self.signatures[row], self.signatures[rows], self._threshold)
+        return is_match
+
+    def query_signatures(self, signatures):
+        """
+        Find indexed near-duplicates of several signatures, verifying all candidates in one vectorized pass
+        :param signatures: List of numpy signature vectors
+        :return matches: List (one per signature) of lists of (doc_id, approximate Jaccard), best match first
+        """
+        query_rows = []
+        candidate_rows = []
+        for query_row, signature in enumerate(signatures):
+            rows = self.candidate_rows(signature)
+            query_rows.append(np.repeat(query_row, len(rows)))
+            candidate_rows.append(rows)
+        matches = [list() for _ in signatures]
+        if not signatures:
+            return matches
+        query_rows = np.concatenate(query_rows).astype(np.int64)
+        candidate_rows = np.concatenate(candidate_rows).astype(np.int64)
+        is_match, scores = JaccardMatchFunction.verify(np.asarray(signatures)[query_rows],
+                                                       self.signatures[candidate_rows], self._threshold)
+        for query_row, row, score in zip(query_rows[is_match], candidate_rows[is_match], scores[is_match]):
+            matches[query_row].append((int(self.doc_ids[row]), float(score)))
+        for match in matches:
+            match.sort(key=lambda doc_score: -doc_score[1])
+        return matches
+
+    def query(self, documents):
+        """
+        :param documents: List of documents, each an iterable of tokens
+        :return matches: List (one per document) of lists of (doc_id, approximate Jaccard), best match first
+        """
+        return self.query_signatures([self.hash_document(document) for document in documents])
+
+
+class LatencyTracker(object):
+    """
+    Rolling window of request latencies, in shared memory so every server process forked after construction
+    records into, and reports from, the same window
+    """
+    def __init__(self, window=10000):
+        """
+        :param window: Number of most recent latencies kept
+        """
+        self._window = window
+        self._latencies = multiprocessing.RawArray('d', window)
+        self._number_requests = multiprocessing.RawValue('l', 0)
+        self._lock = multiprocessing.Lock()
+
+    @property
+    def number_requests(self):
+        return self._number_requests.value
+
+    def add(self, seconds):
+        with self._lock:
+            self._latencies[self._number_requests.value % self._window] = seconds
+            self._number_requests.value += 1
+
+    def percentile(self, q):
+        """
+        :param q: Percentile in [0, 100]
+        :return seconds: Latency percentile over the window, None if nothing has been recorded
+        """
+        with self._lock:
+            number_latencies = min(self._number_requests.value, self._window)
+            latencies = np.frombuffer(self._latencies, dtype=np.float64)[:number_latencies].copy()
+        if not number_latencies:
+            return None
+        return float(np.percentile(latencies, q))
+
+    def summary(self):
+        """
+        :return summary: Dict with request count and p50/p99 latencies in milliseconds, over all server processes
+        """
+        p50 = self.percentile(50)
+        p99 = self.percentile(99)
+        return {
+            'number_requests': self.number_requests,
+            'p50_ms': p50 * 1000 if p50 is not None else None,
+            'p99_ms': p99 * 1000 if p99 is not None else None,
+        }
+
+
+class QueryBatcher(threading.Thread):
+    """
+    Collects concurrent queries and verifies them together with NearDuplicateIndex.query_signatures
+    """
+    def __init__(self, index, max_batch_size=64, max_batch_wait=0.001):
+        """
+        :param index: NearDuplicateIndex object
+        :param max_batch_size: Maximum number of queries per batch
+        :param max_batch_wait: Seconds to wait for more queries once the first query of a batch arrives
+        """
+        super(QueryBatcher, self).__init__()
+        self.daemon = True
+        self._index = index
+        self._max_batch_size = max_batch_size
+        self._max_batch_wait = max_batch_wait
+        self._job_queue = Queue.Queue()
+
+    def query(self, signature):
+        """
+        Blocks until the batch containing signature is verified
+        :param signature: numpy vector of MinHash signature
+        :return matches: List of (doc_id, approximate Jaccard), best match first
+        """
+        return self.query_many([signature])[0]
+
+    def query_many(self, signatures):
+        """
+        Enqueues all signatures before waiting, so they can share batches
+        :param signatures: List of numpy signature vectors
+        :return matches: List (one per signature) of lists of (doc_id, approximate Jaccard), best match first
+        """
+        jobs = [[signature, threading.Event(), None] for signature in signatures]
+        for job in jobs:
+            self._job_queue.put(job)
+        for job in jobs:
+            job[1].wait()
+        for job in jobs:
+            if isinstance(job[2], Exception):
+                raise job[2]
+        return [job[2] for job in jobs]
+
+    def run(self):
+        while True:
+            batch = [self._job_queue.get()]
+            deadline = time.time() + self._max_batch_wait
+            while len(batch) < self._max_batch_size:
+                remaining = deadline - time.time()
+                try:
+                    batch.append(self._job_queue.get(timeout=remaining) if remaining > 0 else
+                                 self._job_queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                results = self._index.query_signatures([job[0] for job in batch])
+            except Exception as e:
+                results = [e for _ in batch]
+            for job, result in zip(batch, results):
+                job[2] = result
+                job[1].set()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(index, batcher, latency):
+    """
+    :param index: NearDuplicateIndex object, for hashing documents
+    :param batcher: Started QueryBatcher object
+    :param latency: LatencyTracker object
+    :return handler: BaseHTTPRequestHandler class answering /query and /stats
+    """
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/query':
+                self.send_error(404)
+                return
+            start = time.time()
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+                documents = body['documents']
+            except (ValueError, KeyError, TypeError):
+                documents = None
+            if not isinstance(documents, list) or not all([isinstance(d, basestring) for d in documents]):
+                self.send_error(400, 'Expected JSON body {"documents": [text, ...]}')
+                return
+            try:
+                signatures = [index.hash_text(document.encode('utf-8')) for document in documents]
+                results = batcher.query_many(signatures)
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            self._send_json({'results': results})
+            latency.add(time.time() - start)
+
+        def do_GET(self):
+            if self.path != '/stats':
+                self.send_error(404)
+                return
+            self._send_json(latency.summary())
+
+        def _send_json(self, obj):
+            body = json.dumps(obj)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return QueryHandler
+
+
+def _serve_forever(server, index, latency, max_batch_size, max_batch_wait):
+    """
+    Run one server process. The batcher thread is started here, since threads do not survive fork.
+    """
+    batcher = QueryBatcher(index, max_batch_size=max_batch_size, max_batch_wait=max_batch_wait)
+    batcher.start()
+    server.RequestHandlerClass = make_handler(index, batcher, latency)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def serve(index_path, host, port, number_processes=1, max_batch_size=64, max_batch_wait=0.001):
+    """
+    Serve near-duplicate queries on host:port. The index is memory mapped before forking, so all
+    server processes share one copy of it and accept connections on the same socket.
+    :param index_path: Directory written by save_index
+    :param host: Address to listen on
+    :param port: Port to listen on
+    :param number_processes: Number of server processes
+    :param max_batch_size: Maximum number of concurrent queries verified together, per process
+    :param max_batch_wait: Seconds to wait for more concurrent queries before verifying a batch
+    """
+    index = NearDuplicateIndex(index_path)
+    latency = LatencyTracker()
+    server = ThreadingHTTPServer((host, port), BaseHTTPRequestHandler)
+    print 'Serving index of ' + str(len(index)) + ' documents on ' + host + ':' + str(port) + \
+          ' with ' + str(number_processes) + ' processes'
+    workers = []
+    for _ in range(number_processes - 1):
+        w = multiprocessing.Process(target=_serve_forever,
+                                    args=(server, index, latency, max_batch_size, max_batch_wait))
+        workers.append(w)
+        w.start()
+    _serve_forever(server, index, latency, max_batch_size, max_batch_wait)
+    for worker in workers:
+        worker.join()
+    server.server_close()
+    summary = latency.summary()
+    print 'Answered ' + str(summary['number_requests']) + ' requests. p50 ' + str(summary['p50_ms']) + \
+          ' ms, p99 ' + str(summary['p99_ms']) + ' ms'
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
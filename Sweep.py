@@ -0,0 +1,244 @@
+import argparse
+from Ingest import iter_documents, Shingler
+from KwikCluster import kwik_cluster, clusters_to_label_array, pairwise_precision_recall_f1
+from MinHash import MinHash, Banding, JaccardMatchFunction
+import numpy as np
+from numpy import Inf
+import sys
+import time
+
+
+__author__ = 'Matt Barnes'
+
+
+_COLUMNS = ['number_hash_functions', 'threshold', 'bandwidth', 'number_bands_per_doc', 'seconds', 'candidates',
+            'memory_bytes', 'precision', 'recall', 'f1', 'pareto']
+
+
+def main(argv):
+    """
+    Sweep thresholds, hash counts and band widths against ground truth labels.
+    Signatures are computed once at the largest hash count, and truncated for smaller hash counts.
+    :param argv: See below
+    :return:
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("input_file_path",
+                        type=str,
+                        help="Path to text file to cluster. One document per line.")
+
+    parser.add_argument("labels_file_path",
+                        type=str,
+                        help="Path to ground truth cluster labels. One integer label per line, aligned with "
+                             "input-file-path (see test/draw_synthetic.py).")
+
+    parser.add_argument("output_file_path",
+                        type=str,
+                        help="Path to output CSV of sweep results, one configuration per line.")
+
+    parser.add_argument("--thresholds",
+                        type=float,
+                        nargs='+',
+                        default=[0.5, 0.7, 0.9],
+                        help="Jaccard score cutoff thresholds to sweep.")
+
+    parser.add_argument("--number-hash-functions",
+                        type=int,
+                        nargs='+',
+                        default=[50, 100, 200],
+                        help="Numbers of hash functions to sweep.")
+
+    parser.add_argument("--bandwidths",
+                        type=int,
+                        nargs='*',
+                        default=[],
+                        help="Rows per band to sweep. If none, chosen from each threshold. Bandwidths that do not divide "
+                             "a number of hash functions are skipped for it.")
+
+    parser.add_argument("--min-f1",
+                        type=float,
+                        default=0.9,
+                        help="Report the fastest configuration with at least this pairwise F1.")
+
+    parser.add_argument("--number-processes",
+                        type=int,
+                        default=1,
+                        help="Number of parallel processes for hashing documents.")
+
+    parser.add_argument("--max-lines",
+                        type=int,
+                        default=Inf,
+                        help="Maximum number of lines to read from input-file-path.")
+
+    parser.add_argument("--shingle",
+                        type=str,
+                        choices=['word', 'char'],
+                        default='word',
+                        help="Tokenize documents into whitespace delimited words or characters.")
+
+    parser.add_argument("--ngram",
+                        type=int,
+                        default=1,
+                        help="Number of consecutive tokens per shingle.")
+
+    args = parser.parse_args(argv)
+
+    signatures = hash_text_file(args.input_file_path, max(args.number_hash_functions), Shingler(args.shingle, args.ngram),
+                                number_processes=args.number_processes, max_lines=args.max_lines)
+    true_labels = np.loadtxt(args.labels_file_path, dtype=np.int64, ndmin=1)[:len(signatures)]
+    results = sweep(signatures, true_labels, args.number_hash_functions, args.thresholds,
+                    bandwidths=args.bandwidths or [None], number_processes=args.number_processes)
+    write_results(args.output_file_path, results)
+    print 'Pareto frontier (fastest first):'
+    for result in sorted([r for r in results if r['pareto']], key=lambda r: r['seconds']):
+        print '    ' + _format_result(result)
+    passing = [result for result in results if result['f1'] >= args.min_f1]
+    if passing:
+        print 'Fastest configuration with F1 >= ' + str(args.min_f1) + ': ' + \
+              _format_result(min(passing, key=lambda r: r['seconds']))
+    else:
+        print 'No configuration reached F1 >= ' + str(args.min_f1)
+
+
+def hash_text_file(file_path, number_hash_functions, shingler, number_processes=1, max_lines=Inf):
+    """
+    :param file_path: Path to text file, one document per line
+    :param number_hash_functions: Int >= 1
+    :param shingler: Ingest.Shingler object
+    :param number_processes: Number of processes to hash documents with
+    :param max_lines: Maximum number of lines to read
+    :return signatures: Numpy uint64 matrix, one row per line
+    """
+    minhash = MinHash(number_hash_functions, number_processes=number_processes)
+    for line_number, line in iter_documents(file_path):
+        if line_number >= max_lines:
+            break
+        minhash.add_document(line_number, shingler(line))
+    minhash.finish()
+    signatures = np.empty((len(minhash.signatures), number_hash_functions), dtype=np.uint64)
+    for doc_id, signature in minhash.signatures.iteritems():
+        signatures[doc_id, :] = signature
+    return signatures
+
+
+def sweep(signatures, true_labels, number_hash_functions, thresholds, bandwidths=(None,), number_processes=1):
+    """
+    Cluster with every configuration, truncating signatures to each number of hash functions
+    :param signatures: Numpy uint64 matrix, one row per doc, with at least max(number_hash_functions) columns
+    :param true_labels: Numpy int vector of ground truth cluster labels, one per doc
+    :param number_hash_functions: List of ints
+    :param thresholds: List of Jaccard thresholds
+    :param bandwidths: List of rows per band. None chooses the bandwidth from the threshold. Bandwidths that do not
+                       divide a number of hash functions are skipped for it, since its bands would be uneven
+    :param number_processes: For banding
+    :return results: List of dicts, one per configuration, with keys in _COLUMNS
+    """
+    results = []
+    for number_hashes in sorted(number_hash_functions):
+        minhash = _TruncatedMinHash(signatures, number_hashes)
+        for threshold in thresholds:
+            for bandwidth in bandwidths:
+                if bandwidth is not None and (bandwidth > number_hashes or number_hashes % bandwidth):
+                    print 'Skipping bandwidth ' + str(bandwidth) + ', which does not divide ' + str(number_hashes) + \
+                          ' hash functions'
+                    continue
+                results.append(_run_configuration(minhash, true_labels, number_hashes, threshold, bandwidth,
+                                                  number_processes))
+    for result, is_pareto in zip(results, pareto_frontier(
+            np.array([[r['seconds'], r['memory_bytes'], -r['f1']] for r in results]))):
+        result['pareto'] = bool(is_pareto)
+    return results
+
+
+def _run_configuration(minhash, true_labels, number_hashes, threshold, bandwidth, number_processes):
+    banding = Banding(number_hashes, threshold, number_processes=number_processes, bandwidth=bandwidth)
+    start = time.time()
+    banding.add_signatures(minhash.signatures)
+    jaccard_match_function = JaccardMatchFunction(minhash, banding)
+    clusters = kwik_cluster(jaccard_match_function.match_function, set(minhash.signatures.keys()))
+    seconds = time.time() - start
+    banding.close()
+    precision, recall, f1 = pairwise_precision_recall_f1(true_labels,
+                                                         clusters_to_label_array(clusters, len(true_labels)))
+    number_bands_per_doc = banding.get_number_bands_per_doc()
+    return {
+        'number_hash_functions': number_hashes,
+        'threshold': threshold,
+        'bandwidth': _band_rows(number_hashes, number_bands_per_doc),
+        'number_bands_per_doc': number_bands_per_doc,
+        'seconds': seconds,
+        'candidates': jaccard_match_function.number_candidates,
+        'memory_bytes': len(true_labels) * number_hashes * minhash.signature_itemsize + banding_bytes(banding),
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+    }
+
+
+def _band_rows(number_hashes, number_bands_per_doc):
+    """
+    :return rows: Rows per band, as split by compute_bands. 'min-max' if the bands are uneven
+    """
+    rows = number_hashes / number_bands_per_doc
+    if number_hashes % number_bands_per_doc:
+        return str(rows) + '-' + str(rows + 1)
+    return str(rows)
+
+
+class _TruncatedMinHash(object):
+    """
+    The signatures JaccardMatchFunction and Banding need from a MinHash object, truncated to the first hash functions
+    """
+    def __init__(self, signatures, number_hash_functions):
+        self.signatures = dict(enumerate(signatures[:, :number_hash_functions]))
+        self.signature_itemsize = signatures.itemsize
+
+
+def banding_bytes(banding):
+    """
+    Approximate memory used by the band dictionaries, via sys.getsizeof of the containers and band digests
+    :param banding: Banding object
+    :return bytes: Int
+    """
+    total = sys.getsizeof(banding.band_to_docs) + sys.getsizeof(banding.doc_to_bands)
+    for band, doc_ids in banding.band_to_docs.iteritems():
+        total += sys.getsizeof(band) + sys.getsizeof(doc_ids)
+    for bands in banding.doc_to_bands.itervalues():
+        total += sys.getsizeof(bands)
+    return total
+
+
+def pareto_frontier(costs):
+    """
+    :param costs: Numpy matrix, one row per configuration, one column per cost to minimize
+    :return is_pareto: Boolean numpy vector, True for configurations no other configuration dominates
+    """
+    if len(costs) == 0:
+        return np.empty(0, dtype=bool)
+    no_worse = np.all(costs[:, np.newaxis, :] <= costs[np.newaxis, :, :], axis=2)
+    better = np.any(costs[:, np.newaxis, :] < costs[np.newaxis, :, :], axis=2)
+    dominates = no_worse & better  # dominates[i, j] is True if configuration i dominates configuration j
+    return ~np.any(dominates, axis=0)
+
+
+def write_results(output_file_path, results):
+    """
+    :param output_file_path: Path to output CSV
+    :param results: List of dicts, as returned by sweep
+    """
+    with open(output_file_path, 'w') as ins:
+        ins.write(','.join(_COLUMNS) + '\n')
+        for result in results:
+            ins.write(','.join([str(result[column]) for column in _COLUMNS]) + '\n')
+
+
+def _format_result(result):
+    return 'hashes ' + str(result['number_hash_functions']) + ', threshold ' + str(result['threshold']) + \
+           ', bandwidth ' + str(result['bandwidth']) + ': ' + '%.3f' % result['seconds'] + ' s, ' + \
+           str(result['candidates']) + ' candidates, ' + str(result['memory_bytes']) + ' bytes, F1 ' + \
+           '%.3f' % result['f1']
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
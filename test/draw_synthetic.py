@@ -1,26 +1,34 @@
 import numpy as np
 
 
-def draw_synthetic(number_records, number_clusters, output='synthetic.txt'):
+def draw_synthetic(number_records, number_clusters, output='synthetic.txt', labels_output=None, seed=None):
     """
     Synthetic datset
     :param number_records:
     :param number_clusters:
+    :param output: Path to write records to, one per line
+    :param labels_output: Path to write labels to, one per line. Not written if None
+    :param seed: Random seed. If None, uses the global numpy random state
     :return records: Dictionary of [doc id, text] where text is a string
     :return labels: Dictionary of [doc id, label] where label is an int
     """
+    random_state = np.random.RandomState(seed) if seed is not None else np.random
     number_features = 20
-    cluster_features = np.random.randint(0, 99999, size=(number_clusters, number_features))
+    cluster_features = random_state.randint(0, 99999, size=(number_clusters, number_features))
     records = dict()
     labels = dict()
     with open(output, 'w') as ins:
         for record_id in range(0, number_records):
-            cluster_id = np.random.randint(0, number_clusters)
-            noise = np.random.randint(0, 2, size=(number_features,))
+            cluster_id = random_state.randint(0, number_clusters)
+            noise = random_state.randint(0, 2, size=(number_features,))
             record_features = cluster_features[cluster_id, :] + noise
             record_features = [str(f) for f in record_features]
             record_text = ' '.join(record_features)
             records[record_id] = record_text
             ins.write(record_text+'\n')
             labels[record_id] = cluster_id
-        return records, labels
+    if labels_output is not None:
+        with open(labels_output, 'w') as ins:
+            for record_id in range(0, number_records):
+                ins.write(str(labels[record_id]) + '\n')
+    return records, labels
@@ -0,0 +1,58 @@
+from Ingest import iter_documents, Shingler
+import gzip
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+__author__ = 'mbarnes1'
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lines = ['And under the boughs unbowed.', 'All clothed in a snowy shroud.', '', 'She had no heart so hardened.']
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_iter_documents(self):
+        path = os.path.join(self.directory, 'plain.txt')
+        with open(path, 'wb') as ins:
+            ins.write('\n'.join(self.lines))  # No trailing line break
+        documents = list(iter_documents(path, block_size=7))
+        self.assertEqual(documents, list(enumerate(self.lines)))
+
+    def test_iter_documents_gzip(self):
+        path = os.path.join(self.directory, 'compressed.txt.gz')
+        for lines in [self.lines[:2], self.lines[2:]]:  # Two concatenated gzip members
+            with gzip.open(path, 'ab') as ins:
+                ins.write(''.join([line + '\r\n' for line in lines]))
+        documents = list(iter_documents(path, block_size=16))
+        self.assertEqual(documents, list(enumerate(self.lines)))
+
+    def test_word_shingles(self):
+        shingler = Shingler('word', 1)
+        shingles = shingler('hello world  hello\n')
+        self.assertEqual(shingles.dtype, np.uint64)
+        self.assertEqual(len(shingles), 3)
+        self.assertEqual(shingles[0], shingles[2])
+        self.assertNotEqual(shingles[0], shingles[1])
+        self.assertEqual(shingler('world hello')[1], shingles[0])
+        self.assertEqual(len(shingler('')), 0)
+
+    def test_ngram_shingles(self):
+        shingles = Shingler('word', 2)('a b a b')
+        self.assertEqual(len(shingles), 3)
+        self.assertEqual(shingles[0], shingles[2])
+        self.assertNotEqual(shingles[0], shingles[1])
+        self.assertEqual(len(Shingler('word', 3)('a b')), 1)
+        shingles = Shingler('char', 3)('abcabc')
+        self.assertEqual(len(shingles), 4)
+        self.assertEqual(shingles[0], shingles[3])
+        self.assertEqual(len(set(shingles)), 3)
+
+    def test_shingles_do_not_collide_linearly(self):
+        self.assertNotEqual(list(Shingler('word', 2)('a cb')), list(Shingler('word', 2)('b ca')))
+        self.assertNotEqual(list(Shingler('word', 1)('ab')), list(Shingler('word', 2)('b a')))
+        self.assertNotEqual(list(Shingler('char', 2)('ab')), list(Shingler('char', 2)('ba')))
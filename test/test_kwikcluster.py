@@ -1,7 +1,16 @@
 from draw_synthetic import draw_synthetic
 from KwikCluster import kwik_cluster, clusters_to_labels, consensus_clustering, JaccardMatchFunction, ConsensusClusteringMatchFunction
+from KwikCluster import clusters_to_label_array, pairwise_precision_recall_f1
+from KwikCluster import kwik_cluster_labels, multi_kwik_cluster, consensus_clustering_labels, label_array_to_clusters
+from KwikCluster import _MemoizedMatchRows, _signature_store
+from MemoryPlanner import MemoryPlan
 from MinHash import MinHash, Banding
+from NearDuplicateIndex import save_index, NearDuplicateIndex
+import numpy as np
+import os
 import Queue
+import shutil
+import tempfile
 import unittest
 __author__ = 'mbarnes1'
 
@@ -21,6 +30,23 @@ class MyTestCase(unittest.TestCase):
         self.assertNotEqual(labels[1], labels[8])
         self.assertNotEqual(labels[1], labels[5])
 
+    def test_clusters_to_label_array(self):
+        clusters = [[1, 2, 3], [0, 4]]
+        labels = clusters_to_label_array(clusters, 6)
+        np.testing.assert_array_equal(labels, [1, 0, 0, 0, 1, 2])
+        labels = clusters_to_label_array([[0]], 4)
+        self.assertEqual(len(set(labels)), 4)
+        self.assertEqual(pairwise_precision_recall_f1(np.arange(4), labels), (1.0, 1.0, 1.0))
+
+    def test_pairwise_precision_recall_f1(self):
+        true_labels = np.array([0, 0, 0, 1, 1])
+        predicted_labels = np.array([5, 5, 7, 7, 7])
+        precision, recall, f1 = pairwise_precision_recall_f1(true_labels, predicted_labels)
+        self.assertAlmostEqual(precision, 2./4)  # (0, 1) and (3, 4) of 4 predicted pairs
+        self.assertAlmostEqual(recall, 2./4)  # (0, 1) and (3, 4) of 4 true pairs
+        self.assertAlmostEqual(f1, 0.5)
+        self.assertEqual(pairwise_precision_recall_f1(true_labels, true_labels + 3), (1.0, 1.0, 1.0))
+
     def test_kwikcluster_minhash(self):
         number_clusters = 2
         number_records = 100
@@ -78,3 +104,80 @@ class MyTestCase(unittest.TestCase):
             all_ids.update(cluster)
         self.assertEqual(all_ids, {1, 2, 3, 4, 5})
 
+    def test_kwik_cluster_labels(self):
+        edges = {0: [0, 1], 1: [0, 1, 2], 2: [1, 2], 3: [3]}
+        match_rows = lambda pivot: np.array(edges[pivot])
+        labels = kwik_cluster_labels(match_rows, 4, np.array([1, 0, 2, 3]))
+        np.testing.assert_array_equal(labels, [0, 0, 0, 1])
+        labels = kwik_cluster_labels(match_rows, 4, np.array([0, 2, 1, 3]))
+        np.testing.assert_array_equal(labels, [0, 0, 1, 2])
+        self.assertEqual(label_array_to_clusters(labels), frozenset([frozenset([0, 1]), frozenset([2]), frozenset([3])]))
+
+    def test_consensus_clustering_labels(self):
+        labels = np.array([[0, 0, 1, 1, 2], [5, 5, 3, 3, 4]])
+        for seed in range(5):
+            clusters = label_array_to_clusters(consensus_clustering_labels(labels, seed=seed))
+            self.assertEqual(clusters, frozenset([frozenset([0, 1]), frozenset([2, 3]), frozenset([4])]))
+        labels = np.array([[0, 0, 0, 1, 1], [0, 0, 1, 1, 1]])
+        consensus = consensus_clustering_labels(labels, seed=0)
+        self.assertNotEqual(consensus[0], consensus[4])
+
+    def test_multi_kwik_cluster(self):
+        number_hash_functions = 200
+        dataset = 'synthetic.txt'
+        _, labels = draw_synthetic(100, 2, output=dataset, seed=0)  # Fixed, so the exact checks below are not flaky
+        minhash = MinHash(number_hash_functions)
+        with open(dataset, 'rb') as ins:
+            for line_number, line in enumerate(ins):
+                minhash.add_document(line_number, line.split(' '))
+        minhash.finish()
+        banding = Banding(number_hash_functions, 0.05)
+        banding.add_signatures(minhash.signatures)
+        banding.close()
+        index_path = tempfile.mkdtemp()
+        try:
+            save_index(index_path, minhash, banding)
+            run_labels = multi_kwik_cluster(index_path, 3, number_processes=2, seed=5)
+        finally:
+            shutil.rmtree(index_path)
+        true_labels = np.array([labels[doc_id] for doc_id in range(100)])
+        self.assertEqual(run_labels.shape, (3, 100))
+        for predicted_labels in run_labels:
+            self.assertEqual(pairwise_precision_recall_f1(true_labels, predicted_labels), (1.0, 1.0, 1.0))
+        consensus = consensus_clustering_labels(run_labels, seed=8)
+        self.assertEqual(pairwise_precision_recall_f1(true_labels, consensus), (1.0, 1.0, 1.0))
+
+    def test_memoized_match_rows(self):
+        number_hash_functions = 100
+        draw_synthetic(100, 5, output='synthetic.txt')
+        minhash = MinHash(number_hash_functions)
+        with open('synthetic.txt', 'rb') as ins:
+            for line_number, line in enumerate(ins):
+                minhash.add_document(line_number, line.split(' '))
+        minhash.finish()
+        banding = Banding(number_hash_functions, 0.5)
+        index_path = tempfile.mkdtemp()
+        try:
+            save_index(index_path, minhash, banding)
+            index = NearDuplicateIndex(index_path, mmap_mode=None)
+        finally:
+            banding.close()
+            shutil.rmtree(index_path)
+        memoized = _MemoizedMatchRows(index)
+        for pivot in list(np.random.RandomState(0).permutation(100)) * 2:
+            np.testing.assert_array_equal(memoized.match_rows(pivot), index.match_rows(pivot))
+        self.assertGreater(memoized.number_reused, memoized.number_verified)
+
+    def test_signature_store(self):
+        spill_path = tempfile.mkdtemp()
+        try:
+            self.assertEqual(_signature_store(MemoryPlan('dict', 'dict', {}, 10), 4, spill_path), dict())
+            signatures = _signature_store(MemoryPlan('compressed', 'array', {}, 10), 4, spill_path)
+            signatures[3] = np.arange(4)
+            self.assertEqual(signatures[3].dtype, np.uint32)
+            signatures = _signature_store(MemoryPlan('memmap', 'memmap', {}, 10), 4, spill_path)
+            signatures[3] = np.arange(4)
+            self.assertIsInstance(signatures[3], np.memmap)
+            self.assertTrue(os.path.exists(os.path.join(spill_path, 'signatures.dat')))
+        finally:
+            shutil.rmtree(spill_path)
@@ -0,0 +1,114 @@
+from Ingest import Shingler
+from MemoryPlanner import parse_bytes, estimate_memory, plan_memory, sample_input, RSSTracker, REPRESENTATIONS
+from MemoryPlanner import anonymous_bytes, child_pids
+import multiprocessing
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+__author__ = 'mbarnes1'
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.number_documents = 10 ** 6
+        self.number_hash_functions = 200
+        self.number_bands_per_doc = 20
+
+    def test_parse_bytes(self):
+        self.assertEqual(parse_bytes('1000'), 1000)
+        self.assertEqual(parse_bytes('512M'), 512 * 2 ** 20)
+        self.assertEqual(parse_bytes('1.5gb'), int(1.5 * 2 ** 30))
+
+    def test_estimate_memory(self):
+        peaks = [max(estimate_memory(self.number_documents, self.number_hash_functions, self.number_bands_per_doc,
+                                     signatures, bands).values()) for signatures, bands in REPRESENTATIONS]
+        self.assertEqual(peaks, sorted(peaks, reverse=True))
+        array = estimate_memory(self.number_documents, self.number_hash_functions, self.number_bands_per_doc,
+                                'array', 'array')
+        signature_bytes = self.number_documents * self.number_hash_functions * 8
+        self.assertGreaterEqual(array['hashing'], signature_bytes)
+        # Every doc may end up in its own frozenset
+        self.assertGreaterEqual(array['clustering'] - array['hashing'],
+                                self.number_documents * sys.getsizeof(frozenset([0])))
+        # Pages of memory mapped signatures and indices are not anonymous memory
+        memmap = estimate_memory(self.number_documents, self.number_hash_functions, self.number_bands_per_doc,
+                                 'memmap', 'memmap')
+        self.assertGreaterEqual(array['hashing'] - memmap['hashing'], signature_bytes)
+        compressed_array, compressed_memmap = [
+            estimate_memory(self.number_documents, self.number_hash_functions, self.number_bands_per_doc,
+                            'compressed', bands) for bands in ('array', 'memmap')]
+        self.assertGreaterEqual(compressed_array['clustering'] - compressed_memmap['clustering'], signature_bytes / 2)
+
+    def test_estimate_memory_runs(self):
+        single = estimate_memory(self.number_documents, self.number_hash_functions, self.number_bands_per_doc,
+                                 'memmap', 'memmap')
+        runs = estimate_memory(self.number_documents, self.number_hash_functions, self.number_bands_per_doc,
+                               'memmap', 'memmap', number_runs=8, number_processes=4)
+        # The label matrix and the two sorted copies consensus clustering makes of it
+        self.assertGreaterEqual(runs['clustering'] - single['clustering'], 2 * 3 * 8 * self.number_documents * 8)
+        more_processes = estimate_memory(self.number_documents, self.number_hash_functions, self.number_bands_per_doc,
+                                         'memmap', 'memmap', number_runs=8, number_processes=8)
+        # Each worker memoizes a match array per pivot
+        self.assertGreaterEqual(more_processes['clustering'] - runs['clustering'], 4 * self.number_documents * 8)
+        # Banding workers computing band dictionaries may copy the baseline memory they were forked with
+        dict_bands = [estimate_memory(self.number_documents, self.number_hash_functions, self.number_bands_per_doc,
+                                      'dict', 'dict', baseline_bytes=10 ** 7, number_processes=number_processes)
+                      for number_processes in (1, 4)]
+        self.assertGreaterEqual(dict_bands[1]['banding'] - dict_bands[0]['banding'], 3 * 10 ** 7)
+        self.assertRaises(ValueError, estimate_memory, self.number_documents, self.number_hash_functions,
+                          self.number_bands_per_doc, 'dict', 'dict', number_runs=8)
+        plan = plan_memory(self.number_documents, self.number_hash_functions, self.number_bands_per_doc,
+                           baseline_bytes=0, number_runs=8)
+        self.assertNotEqual(plan.bands, 'dict')
+
+    def test_plan_memory(self):
+        plan = plan_memory(self.number_documents, self.number_hash_functions, self.number_bands_per_doc,
+                           baseline_bytes=0)
+        self.assertEqual((plan.signatures, plan.bands), ('dict', 'dict'))
+        budget = plan.peak_bytes - 1
+        plan = plan_memory(self.number_documents, self.number_hash_functions, self.number_bands_per_doc,
+                           memory_budget=budget, baseline_bytes=0)
+        self.assertEqual((plan.signatures, plan.bands), ('compressed', 'dict'))
+        self.assertLessEqual(plan.peak_bytes, budget)
+        self.assertEqual(plan.number_documents, self.number_documents)
+        self.assertRaises(MemoryError, plan_memory, self.number_documents, self.number_hash_functions,
+                          self.number_bands_per_doc, memory_budget=10 ** 6, baseline_bytes=0)
+
+    def test_sample_input(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'input.txt')
+            with open(path, 'w') as ins:
+                for _ in range(100):
+                    ins.write('one two three\n')
+            self.assertEqual(sample_input(path, Shingler()), (100, 3.))
+            self.assertEqual(sample_input(path, Shingler(), number_samples=10), (100, 3.))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_rss_tracker(self):
+        plan = plan_memory(self.number_documents, self.number_hash_functions, self.number_bands_per_doc)
+        tracker = RSSTracker(plan)
+        try:
+            hashing = tracker.checkpoint('hashing')
+            self.assertGreater(hashing, 0)
+            array = np.ones(64 << 20, dtype=np.uint8)  # Freed again before the next checkpoint
+            time.sleep(0.1)
+            del array
+            self.assertGreaterEqual(tracker.checkpoint('banding'), hashing + (48 << 20))
+        finally:
+            tracker.close()
+        self.assertIn('hashing', tracker.stage_bytes)
+
+    def test_child_pids(self):
+        child = multiprocessing.Process(target=time.sleep, args=(1,))
+        child.start()
+        try:
+            self.assertIn(child.pid, child_pids())
+            self.assertGreater(anonymous_bytes([child.pid]), 0)
+        finally:
+            child.join()
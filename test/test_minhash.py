@@ -1,6 +1,10 @@
 from draw_synthetic import draw_synthetic
-from MinHash import MinHash, Banding
+from Ingest import Shingler
+from MinHash import MinHash, Banding, DenseSignatures, signature_band_keys
 import numpy as np
+import os
+import shutil
+import tempfile
 import timeit
 import unittest
 
@@ -53,6 +57,48 @@ class MyTestCase(unittest.TestCase):
         j = self.minhash.jaccard(0, 1)
         self.assertAlmostEqual(j, 10./30, delta=0.05)
 
+    def test_jaccard_integer_shingles(self):
+        shingler = Shingler()
+        minhash = MinHash(1000, number_processes=0)
+        doc1 = ' '.join(['s'+str(i) for i in range(1, 1000)])
+        doc2 = ' '.join(['s'+str(i) for i in range(300, 1100)])
+        sig1 = minhash.hash_document(shingler(doc1))
+        sig2 = minhash.hash_document(shingler(doc2))
+        self.assertEqual(sig1.shape, (1000,))
+        np.testing.assert_array_equal(sig1, minhash.hash_document(shingler(doc1)))
+        np.testing.assert_array_equal(sig1[:self.number_hash_functions], self.minhash.hash_document(shingler(doc1)))
+        minhash.signatures[0] = sig1
+        minhash.signatures[1] = sig2
+        j = minhash.jaccard(0, 1)
+        self.assertAlmostEqual(j, 701.0/1100, delta=0.05)
+
+    def test_dense_signatures(self):
+        signatures = DenseSignatures(self.number_hash_functions, number_docs=2, dtype=np.uint32)
+        minhash = MinHash(self.number_hash_functions, number_processes=0, signatures=signatures)
+        for doc_id in [0, 4, 2]:
+            minhash.signatures[doc_id] = self.minhash.hash_document(['s' + str(doc_id), 'shared'])
+        self.assertEqual(len(signatures), 3)
+        self.assertEqual(signatures.keys(), [0, 2, 4])
+        np.testing.assert_array_equal(signatures.doc_ids(), [0, 2, 4])
+        self.assertNotIn(1, signatures)
+        self.assertRaises(KeyError, signatures.__getitem__, 1)
+        np.testing.assert_array_equal(signatures[4], self.minhash.hash_document(['s4', 'shared']).astype(np.uint32))
+        self.assertEqual([doc_id for doc_id, _ in signatures.iteritems()], [0, 2, 4])
+        self.assertAlmostEqual(minhash.jaccard(0, 2), 1. / 3, delta=0.15)
+
+    def test_dense_signatures_memmap(self):
+        directory = tempfile.mkdtemp()
+        try:
+            signatures = DenseSignatures(self.number_hash_functions, number_docs=1,
+                                         path=os.path.join(directory, 'signatures.dat'))
+            signature = self.minhash.hash_document(['hello'])
+            signatures[0] = signature
+            signatures[3] = signature
+            np.testing.assert_array_equal(signatures[0], signature)
+            np.testing.assert_array_equal(signatures[3], signature)
+        finally:
+            shutil.rmtree(directory)
+
     def test_add_signatures(self):
         number_tests = 1
         number_threads = 4
@@ -78,5 +124,20 @@ class MyTestCase(unittest.TestCase):
         print 'Single process banding time: ' + str(duration_single)
         print str(number_threads) + '-process banding time: ' + str(duration_multi)
 
+    def test_signature_band_keys(self):
+        signatures = np.random.RandomState(0).randint(0, 1 << 32, size=(5, 7)).astype(np.uint64)
+        keys = signature_band_keys(3, signatures)  # Bands of 3, 2 and 2 values, as np.array_split
+        self.assertEqual(keys.shape, (5, 3))
+        self.assertEqual(keys.dtype, np.uint64)
+        self.assertTrue(np.array_equal(keys[2], signature_band_keys(3, signatures[2])[0]))
+        self.assertTrue(np.array_equal(keys, signature_band_keys(3, signatures.astype(np.uint32))))
+        changed = signatures.copy()
+        changed[:, 3] += np.uint64(1)
+        is_changed = signature_band_keys(3, changed) != keys
+        self.assertTrue(np.all(is_changed[:, 1]))
+        self.assertFalse(np.any(is_changed[:, [0, 2]]))
+        repeated = np.zeros((1, 6), dtype=np.uint64)
+        self.assertEqual(len(set(signature_band_keys(3, repeated)[0])), 3)  # Band number is part of the key
+
 
     #def test_calculate_bandwidth(self):
\ No newline at end of file
@@ -0,0 +1,135 @@
+from draw_synthetic import draw_synthetic
+from Ingest import Shingler
+from MinHash import MinHash, Banding, JaccardMatchFunction, DenseSignatures
+from NearDuplicateIndex import save_index, NearDuplicateIndex, QueryBatcher, LatencyTracker
+import json
+import multiprocessing
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+__author__ = 'mbarnes1'
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.number_hash_functions = 200
+        self.threshold = 0.5
+        self.index_path = tempfile.mkdtemp()
+        _ = draw_synthetic(100, 10)
+        self.documents = []
+        self.minhash = MinHash(self.number_hash_functions)
+        with open('synthetic.txt', 'rb') as ins:
+            for line_number, line in enumerate(ins):
+                tokens = line.split(' ')
+                self.documents.append(tokens)
+                self.minhash.add_document(line_number, tokens)
+        self.minhash.finish()
+        self.banding = Banding(self.number_hash_functions, self.threshold)
+        self.banding.add_signatures(self.minhash.signatures)
+        save_index(self.index_path, self.minhash, self.banding)
+        self.index = NearDuplicateIndex(self.index_path)
+
+    def tearDown(self):
+        self.banding.close()
+        shutil.rmtree(self.index_path)
+
+    def test_verify(self):
+        signature = np.array([1, 2, 3, 4], dtype=np.uint64)
+        candidates = np.array([[1, 2, 3, 4], [1, 2, 0, 0], [0, 0, 0, 0]], dtype=np.uint64)
+        is_match, scores = JaccardMatchFunction.verify(signature, candidates, 0.4)
+        np.testing.assert_array_equal(scores, [1.0, 0.5, 0.0])
+        np.testing.assert_array_equal(is_match, [True, True, False])
+
+    def test_hash_document(self):
+        np.testing.assert_array_equal(self.index.hash_document(self.documents[3]), self.minhash.signatures[3])
+
+    def test_query(self):
+        match_function = JaccardMatchFunction(self.minhash, self.banding).match_function
+        results = self.index.query(self.documents)
+        for doc_id, matches in enumerate(results):
+            self.assertEqual(matches[0], (doc_id, 1.0))
+            self.assertSetEqual(set([match for match, _ in matches]), match_function(doc_id))
+
+    def test_hash_text_shingles(self):
+        shingler = Shingler('word', 2)
+        signature = self.minhash.hash_document(shingler('a b c d'))
+        save_index(self.index_path, self.minhash, self.banding, shingler=shingler)
+        index = NearDuplicateIndex(self.index_path)
+        np.testing.assert_array_equal(index.hash_text('a b c d'), signature)
+
+    def test_other_band_keys(self):
+        with open(os.path.join(self.index_path, 'index.json'), 'r') as ins:
+            meta = json.load(ins)
+        del meta['band_keys']
+        with open(os.path.join(self.index_path, 'index.json'), 'w') as ins:
+            json.dump(meta, ins)
+        self.assertRaises(ValueError, NearDuplicateIndex, self.index_path)
+
+    def test_save_index_without_band_dicts(self):
+        signatures = DenseSignatures(self.number_hash_functions, dtype=np.uint32)
+        for doc_id, signature in self.minhash.signatures.iteritems():
+            signatures[doc_id] = signature
+        minhash = MinHash(self.number_hash_functions, number_processes=0, signatures=signatures)
+        banding = Banding(self.number_hash_functions, self.threshold, number_processes=2)
+        index_path = tempfile.mkdtemp()
+        try:
+            save_index(index_path, minhash, banding)
+            index = NearDuplicateIndex(index_path, mmap_mode=None)
+        finally:
+            banding.close()
+            shutil.rmtree(index_path)
+        self.assertEqual(index.signatures.dtype, np.uint32)
+        for doc_id in range(len(self.documents)):
+            self.assertEqual(set(index.match_rows(doc_id)), set(self.index.match_rows(doc_id)))
+        self.assertEqual(index.query(self.documents[:1])[0][0], (0, 1.0))
+
+    def test_candidate_rows_print_options(self):
+        signature = self.minhash.signatures[3]
+        rows = self.index.candidate_rows(signature)
+        options = np.get_printoptions()
+        np.set_printoptions(threshold=5, linewidth=20)
+        try:
+            self.assertTrue(np.array_equal(self.index.candidate_rows(signature), rows))
+        finally:
+            np.set_printoptions(**options)
+        self.assertIn(3, rows)
+
+    def test_batcher(self):
+        batcher = QueryBatcher(self.index, max_batch_size=8)
+        batcher.start()
+        signature = self.minhash.signatures[7]
+        self.assertEqual(batcher.query(signature), self.index.query_signatures([signature])[0])
+
+    def test_latency_tracker(self):
+        latency = LatencyTracker()
+        self.assertIsNone(latency.percentile(50))
+        for seconds in range(1, 101):
+            latency.add(seconds / 1000.)
+        summary = latency.summary()
+        self.assertEqual(summary['number_requests'], 100)
+        self.assertAlmostEqual(summary['p50_ms'], 50.5)
+        self.assertAlmostEqual(summary['p99_ms'], 99.01)
+
+    def test_latency_tracker_shared(self):
+        latency = LatencyTracker(window=4)
+        worker = multiprocessing.Process(target=latency.add, args=(0.5,))
+        worker.start()
+        worker.join()
+        for _ in range(4):
+            latency.add(0.001)
+        self.assertEqual(latency.number_requests, 5)
+        self.assertAlmostEqual(latency.percentile(100), 0.001)  # Oldest latency left the window
+        latency = LatencyTracker()
+        worker = multiprocessing.Process(target=latency.add, args=(0.5,))
+        worker.start()
+        worker.join()
+        self.assertEqual(latency.summary()['number_requests'], 1)
+        self.assertAlmostEqual(latency.percentile(50), 0.5)
+
+    def test_batcher_query_many(self):
+        batcher = QueryBatcher(self.index, max_batch_size=8)
+        batcher.start()
+        signatures = [self.minhash.signatures[doc_id] for doc_id in range(5)]
+        self.assertEqual(batcher.query_many(signatures), self.index.query_signatures(signatures))
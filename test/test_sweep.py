@@ -0,0 +1,29 @@
+from draw_synthetic import draw_synthetic
+from Ingest import Shingler
+from Sweep import hash_text_file, sweep, pareto_frontier, _band_rows
+import numpy as np
+import unittest
+__author__ = 'mbarnes1'
+
+
+class MyTestCase(unittest.TestCase):
+    def test_pareto_frontier(self):
+        costs = np.array([[1., 5.], [2., 2.], [3., 3.], [5., 1.], [1., 5.]])
+        np.testing.assert_array_equal(pareto_frontier(costs), [True, True, False, True, True])
+
+    def test_sweep(self):
+        _, labels = draw_synthetic(100, 2, output='synthetic.txt')
+        true_labels = np.array([labels[record_id] for record_id in range(100)])
+        signatures = hash_text_file('synthetic.txt', 100, Shingler())
+        self.assertEqual(signatures.shape, (100, 100))
+        results = sweep(signatures, true_labels, [50, 100], [0.05, 0.9], bandwidths=[None, 1, 4])
+        self.assertEqual(len(results), 10)  # Bandwidth 4 does not divide 50
+        self.assertEqual([result['bandwidth'] for result in results if result['number_hash_functions'] == 50 and
+                          result['threshold'] == 0.05][1:], ['1'])
+        self.assertTrue(any([result['pareto'] for result in results]))
+        self.assertEqual(_band_rows(100, 33), '3-4')
+        self.assertEqual(_band_rows(100, 25), '4')
+        for result in results:
+            self.assertGreater(result['memory_bytes'], 0)
+            if result['threshold'] == 0.05 and result['bandwidth'] == '1':
+                self.assertGreater(result['f1'], 0.9)